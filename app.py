@@ -1,19 +1,290 @@
 from flask import Flask, jsonify
 import flask
-
+from elastic_transport import ConnectionTimeout
+import csv
+import io
+import json
+import logging
+import os
+import time
+
+import config
+import metrics
+import utils
 import elastic_functions
+import async_elastic_functions
 from elastic_functions import ESKNN
+from async_elastic_functions import AsyncESKNN
+from link_index import link_id, link_index
+from join_graph import join_graph, traverse
+
+utils.setup_logging()
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.json = utils.JSONProvider(app)#orjson when installed; same bytes as flask's own provider except for floats like 1e16 and NaN, see utils.JSONProvider
 
 # Check the index
 esknn = ESKNN()
+aesknn = AsyncESKNN()
+
+
+@app.before_request
+def start_link_index():
+    link_index.start()#loads the link tables into memory in the background, once per worker process
+
+
+@app.before_request
+def start_timer():
+    flask.g.started = time.perf_counter()
+
+
+def count_bytes(chunks, sent):
+    for chunk in chunks:
+        data = chunk.encode() if isinstance(chunk, str) else chunk#encoded once here, so werkzeug passes the bytes on as they are
+        sent[0] += len(data)
+        yield data
+
+
+@app.after_request
+def record_request(response):
+    '''
+    Time every request and count the bytes sent, for /metrics and the slow request log. The clock stops when the
+    response is closed, ie after the last byte, so streamed responses are timed in full.
+    '''
+    started = flask.g.get('started', time.perf_counter())
+    endpoint = flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'#the route, not the URL, to keep labels few
+    method = flask.request.method
+    sent = [0]
+    if response.is_streamed:
+        response.response = count_bytes(response.response, sent)
+    else:
+        sent[0] = response.content_length or 0
+
+    def done():
+        seconds = time.perf_counter() - started
+        metrics.REQUEST_SECONDS.observe(seconds, endpoint=endpoint, method=method, status=response.status_code)
+        metrics.RESPONSE_BYTES.inc(sent[0], endpoint=endpoint)
+        log.log(logging.WARNING if seconds >= config.LOG_SLOW_REQUESTS else logging.DEBUG, '%s %s %d in %.3fs',
+                method, endpoint, response.status_code, seconds,
+                extra={'endpoint': endpoint, 'status': response.status_code, 'seconds': round(seconds, 4), 'bytes': sent[0]})
+
+    response.call_on_close(done)
+    return response
+
+
+@app.errorhandler(ConnectionTimeout)
+def elastic_timeout(error):
+    '''
+    A request to elastic got no answer in time, eg a search that can not return part of its result when its deadline passes
+    '''
+    log.warning('Elastic did not answer in time', extra={'endpoint': flask.request.path})
+    return {
+        "status": 504,
+        "response": "Elastic did not answer in time. Try a narrower request or a longer 'timeout' (seconds)"
+    }, 504
+
+
+def chunked(texts):
+    '''
+    Group a stream of small strings into chunks of about STREAM_CHUNK_BYTES for a streamed response.
+    The first string is passed on right away, so the client gets its first byte without waiting for a full chunk.
+    '''
+    buffer, size, first = [], 0, True
+    for text in texts:
+        buffer.append(text)
+        size += len(text)
+        if first or size >= config.STREAM_CHUNK_BYTES:
+            yield ''.join(buffer)
+            buffer, size, first = [], 0, False
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_ndjson(records, deadline=None):
+    '''
+    Stream records as newline-delimited JSON (one record per line) with chunked transfer encoding.
+    If the deadline cut the records short, the stream ends with a {"partial":true} line.
+
+    :param records: any iterable of json-serialisable objects, usually a generator over elastic hits
+    :param deadline: optional Deadline the records were gathered under
+    :return: flask response
+    '''
+    def lines():
+        for record in records:
+            yield app.json.dumps(record, separators=(',', ':')) + '\n'
+        if deadline is not None and deadline.partial:
+            yield '{"partial":true}\n'
+
+    return flask.Response(flask.stream_with_context(chunked(lines())), mimetype='application/x-ndjson')
+
+
+def stream_download(records, return_as, columns=None):
+    '''
+    Stream records as a file download in one of the formats in utils.FORMATS (ris, pubmed or csv), converting one
+    record at a time, so that exports of any size are never built in memory as a whole.
+
+    :param records: any iterable of documents, usually a generator over elastic hits
+    :param return_as: the download format
+    :param columns: optional list of CSV columns, eg the 'include' fields of the request (wildcards allowed)
+    :return: flask response, or a status 400 dict for unknown formats
+    '''
+    if return_as not in utils.FORMATS:
+        return {
+            "status": 400,
+            "response": "Unknown return_as {}, use dict, {}".format(return_as, ', '.join(utils.FORMATS))
+        }
+    mimetype, extension = utils.FORMATS[return_as]
+    return flask.Response(flask.stream_with_context(chunked(utils.format_output(records, return_as, columns))),
+                          mimetype=mimetype,
+                          headers={'Content-Disposition': 'attachment; filename=meerkat.{}'.format(extension)})
+
+
+def request_deadline(data, stream=False):
+    '''
+    The Deadline of this request, counted from its arrival: the optional 'timeout' JSON param in seconds (at most
+    MAX_REQUEST_DEADLINE), else REQUEST_DEADLINE, or STREAM_DEADLINE for streamed responses. None if that is 0 in
+    config.py; a request can not switch its deadline off, a 'timeout' that is not a positive number is ignored.
+    '''
+    default = config.STREAM_DEADLINE if stream else config.REQUEST_DEADLINE
+    if not default:
+        return None
+    try:
+        seconds = float(data.get('timeout') or default)
+    except (TypeError, ValueError):
+        seconds = default
+    if not seconds > 0:#also false for NaN
+        seconds = default
+    return elastic_functions.Deadline(min(seconds, config.MAX_REQUEST_DEADLINE), start=flask.g.get('started'))
+
+
+def with_partial(response, deadline):
+    '''
+    Add "partial": true to a response dict if the deadline cut one of its elastic hops short
+    '''
+    if deadline is not None and deadline.partial:
+        response["partial"] = True
+        log.info('Returned a partial result', extra={'endpoint': flask.request.path})
+    return response
+
+
+def source_fields(data):
+    '''
+    The optional 'include' and 'exclude' JSON params, ie the fields to return from each document or to leave out.
+    Both can be lists of field names or comma-separated strings, and may use wildcards, eg "include": ["Title", "Author*"].
+    :return: (include list, exclude list)
+    '''
+    def as_list(value):
+        if isinstance(value, str):
+            return [v.strip() for v in value.split(',') if v.strip()]
+        return list(value or [])
+
+    return as_list(data.get('include')), as_list(data.get('exclude'))
+
+
+def search_page(data, ret_field, return_docs):
+    '''
+    Answer a paged search request, ie one that sent 'size' and/or 'cursor' in its JSON body, with one page of hits
+    and the cursor for the next page ("cursor" is null after the last page).
+    '''
+    include, exclude = source_fields(data)
+    deadline = request_deadline(data)
+    try:
+        result, cursor = esknn.search_page(data.get('input', False), ret_field=ret_field, return_docs=return_docs,
+                                           index=data.get('index', False), size=data.get('size', config.PAGE_SIZE),
+                                           cursor=data.get('cursor'), include=include, exclude=exclude, deadline=deadline)
+    except ValueError as e:
+        return {
+            "status": 400,
+            "response": str(e)
+        }
+
+    return with_partial({
+        "status": 200,
+        "response": result,
+        "cursor": cursor
+    }, deadline)
+
+
+def count_query(data):
+    '''
+    Answer a count request, ie one that sent "count": true and/or 'facets' in its JSON body, with the total number
+    of hits and the requested aggregations instead of the hits themselves.
+    '''
+    query = data.get('input', False)
+    if not query:
+        return {
+            "status": 400,
+            "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"title:\"genome dried\"~15\"} "
+        }
+    deadline = request_deadline(data)
+    try:
+        result = esknn.count_query(query, index=data.get('index', False), facets=data.get('facets'), deadline=deadline)
+    except ValueError as e:
+        return {
+            "status": 400,
+            "response": str(e)
+        }
+
+    return with_partial({
+        "status": 200,
+        "response": result
+    }, deadline)
 
 
 @app.route('/', methods=['GET'])
 def home():
     return 'Elastic search API is online :)'
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    '''
+    Liveness check: answers as long as the worker process runs, without talking to elastic.
+    Usage:
+        print(requests.get('http://localhost:9090/healthz').text)
+    '''
+    return jsonify({"status": 200, "pid": os.getpid()})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    '''
+    Readiness check: HTTP 200 if elastic answers a ping, else HTTP 503. Also reports the nodes of this worker's
+    connection pool and which link tables are in memory.
+    Usage:
+        print(requests.get('http://localhost:9090/readyz').text)
+    Result:
+        {
+          "elastic": {"connections_per_node": 10, "nodes": [{"alive": true, "connections": 2, "host": "http://localhost:9200", "idle_connections": 2, "requests": 40}], "reachable": true},
+          "link_index": {"enabled": true, "missing": [], "running": true, "tables": {"tblstudyreport": {"age": 12.5, "links": 3000}}},
+          "pid": 4242,
+          "status": 200
+        }
+    '''
+    elastic = elastic_functions.pool_state()
+    status = 200 if elastic['reachable'] else 503
+    return jsonify(
+        {
+            "status": status,
+            "pid": os.getpid(),
+            "elastic": elastic,
+            "link_index": link_index.state()
+        }
+    ), status
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''
+    Request latency, elastic round trips and 'took', bytes, hits per step ('hop') and cache counters of this worker
+    process, in Prometheus text format. To find the slow step of eg /api/studyfromanyid, compare hop_duration_seconds
+    of its hops: link_index (or lookup on the link table) and then lookup on tblstudy.
+    Usage:
+        print(requests.get('http://localhost:9090/metrics').text)
+    '''
+    return flask.Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/get_current_index', methods=['GET'])
 def get_names():
     '''
@@ -34,6 +305,30 @@ def get_names():
     )
 
 
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    '''
+    Returns size, hit and miss counts of the document cache behind get_documents and the join endpoints, and of the
+    search result cache behind search_query and direct_retrieval ('shared' counts searches that waited for an identical
+    one that was already running, instead of asking elastic again).
+    Usage:
+        print(requests.get('http://localhost:9090/api/cache_stats').text)
+    Result:
+        {
+          "documents": {"entries": 1200, "evictions": 0, "hit_rate": 0.6667, "hits": 2400, "max_entries": 50000, "misses": 1200, "ttl": 600},
+          "queries": {"calls": 40, "entries": 12, "evictions": 0, "hit_rate": 0.5, "hits": 60, "max_entries": 1000, "misses": 60, "running": 0, "shared": 20, "ttl": 10},
+          "status": 200
+        }
+    '''
+    return jsonify(
+        {
+            "status": 200,
+            "documents": elastic_functions.doc_cache.stats(),
+            "queries": {**elastic_functions.query_cache.stats(), **elastic_functions.query_flight.stats()}
+        }
+    )
+
+
 @app.route('/api/set_current_index', methods=['GET','POST'])
 def set_names():
     '''
@@ -84,6 +379,19 @@ def direct_retrieval():
 
     input: A string that is an elastic-style search query, for example "Abstract:schizo* AND Authors:*dams"
     index: The index name to search, for example 'tblreport'
+    stream: Optional, true streams the hits back as newline-delimited JSON (one document per line) while they are scrolled
+    size: Optional, return only one page of this many hits plus a "cursor" for the next page
+    cursor: Optional, the "cursor" returned by the previous page. Input and index can be left out when a cursor is sent
+    count: Optional, true returns only {"total": N, "facets": {...}} and no hits, see /api/search_query
+    facets: Optional, aggregations to return with the count, see /api/search_query
+    include: Optional, list of fields to return from each document, eg ["CRGReportID", "Title", "Authors"]
+    exclude: Optional, list of fields to leave out of each document, eg ["Abstract"]
+    return_as: Optional, 'ris', 'pubmed' or 'csv' streams a file download of the hits instead of JSON
+    slices: Optional, read very large results as this many scroll slices in parallel (default SCAN_SLICES, at most
+        MAX_SCAN_SLICES). Useful up to the number of shards of the index; the hits then come in no fixed order
+    timeout: Optional, seconds this request may spend on elastic (default REQUEST_DEADLINE, STREAM_DEADLINE for
+        streams and downloads). When they run out, the scroll is stopped and the hits found so far are returned with
+        "partial": true; a cut NDJSON stream ends with a {"partial":true} line
 
 
     usage: print(requests.post('http://localhost:9090/api/direct_retrieval', json={"input":"Abstract:schizo* AND Authors:*dams", "index":"tblreport"}).text)
@@ -94,10 +402,31 @@ def direct_retrieval():
     query = data.get('input', False)
     indexname= data.get('index', False)
     ret_field=""
-    esknn.set_index_name(indexname)
+    include, exclude = source_fields(data)
+
+    if data.get('count', False) or data.get('facets', False):
+        return count_query(data)
+
+    if data.get('size', False) or data.get('cursor', False):
+        return search_page(data, ret_field, return_docs=True)
 
     if query:
-        result = esknn.search_query(query,ret_field=ret_field,return_docs=True)
+        slices = data.get('slices', config.SCAN_SLICES)
+        return_as = data.get('return_as', config.RETURN_AS)
+        deadline = request_deadline(data, stream=return_as != 'dict' or data.get('stream', False))
+        try:
+            if return_as != 'dict':
+                return stream_download(esknn.iter_query(query,ret_field=ret_field,return_docs=True,index=indexname,include=include,exclude=exclude,slices=slices,deadline=deadline),
+                                       return_as, columns=include or None)
+            if data.get('stream', False):
+                return stream_ndjson(esknn.iter_query(query,ret_field=ret_field,return_docs=True,index=indexname,include=include,exclude=exclude,slices=slices,deadline=deadline),
+                                     deadline)
+            result = esknn.search_query(query,ret_field=ret_field,return_docs=True,index=indexname,include=include,exclude=exclude,slices=slices,deadline=deadline)
+        except ValueError as e:#rejected by the query analyzer
+            return {
+                "status": 400,
+                "response": str(e)
+            }
 
 
 
@@ -107,10 +436,10 @@ def direct_retrieval():
                 "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"title:\"genome dried\"~15\"} "
             }
 
-    return {
+    return with_partial({
         "status": 200,
         "response":result
-    }
+    }, deadline)
 
 @app.route('/api/reportsfromstudyid', methods=['GET','POST'])
 def reports_from_studyid():
@@ -120,8 +449,13 @@ def reports_from_studyid():
 
     JSON param 'return_as':
         'dict': simply returns a list of dictionaries.
-        'ris': TODO we can return a RIS fiel as single string for direct reference download, if needed?
-        'pubmed': TODO
+        'ris': streams a RIS file download of the documents
+        'pubmed': streams a MEDLINE/PubMed-style text file download of the documents
+        'csv': streams a CSV file download of the documents
+
+    JSON params 'include' and 'exclude': Optional, lists of fields to return from or leave out of each document.
+
+    JSON param 'timeout': Optional, seconds this request may spend on elastic, see /api/direct_retrieval.
 
 
     usage: print(requests.post('http://localhost:9090/api/reportsfromstudyid', json={"input":[138,139]}).text)
@@ -130,24 +464,33 @@ def reports_from_studyid():
     data = flask.request.json
 
     ids = data.get('input', False)
-    print(ids)
-
-    esknn.set_index_name("tblstudyreport")
+    log.debug('Got %d input ids', len(ids or []))
+    include, exclude = source_fields(data)
 
     ret_field="CRGStudyID"#the field to search
+    return_as = data.get('return_as', config.RETURN_AS)
+    deadline = request_deadline(data, stream=return_as != 'dict')
 
     if ids:
-        result = esknn.retrieve_documents(ids,ret_field=ret_field)#get report ID data from study ids
-        ids=[d['CRGReportID'] for d in result]
-        stids = [d['CRGStudyID'] for d in result]
+        links = link_index.get("tblstudyreport")
+        if links is not None:#answer the first hop from memory
+            pairs = links.from_studies(ids)
+            ids=[p[1] for p in pairs]
+            stids=[p[0] for p in pairs]
+        else:
+            result = esknn.retrieve_documents(ids,ret_field=ret_field,index="tblstudyreport",include=["CRGReportID","CRGStudyID"],deadline=deadline)#get report ID data from study ids
+            ids=[link_id(d['CRGReportID']) for d in result]
+            stids = [link_id(d['CRGStudyID']) for d in result]
         assert len(ids)==len(stids)
 
 
-        esknn.set_index_name("tblreport")#get study metadata
         ret_field = "CRGReportID"  # the field to search
         #
         ids=list(set(ids))
-        result = esknn.retrieve_documents(ids, ret_field=ret_field)
+        if return_as != 'dict':
+            return stream_download(esknn.iter_documents(ids, ret_field=ret_field, index="tblreport", include=include, exclude=exclude, deadline=deadline),
+                                   return_as, columns=include or None)
+        result = esknn.retrieve_documents(ids, ret_field=ret_field, index="tblreport", include=include, exclude=exclude, deadline=deadline)#get study metadata
 
 
 
@@ -157,12 +500,12 @@ def reports_from_studyid():
                 "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"title:\"genome dried\"~15\"} "
             }
 
-    return {
+    return with_partial({
         "status": 200,
         "response":result,
         "studyids":stids,
         "reportids":ids
-    }
+    }, deadline)
 
 @app.route('/api/studyfromanyid', methods=['GET','POST'])
 def study_from_any_id():
@@ -172,8 +515,13 @@ def study_from_any_id():
 
     JSON param 'return_as':
         'dict': simply returns a list of dictionaries.
-        'ris': TODO we can return a RIS fiel as single string for direct reference download, if needed?
-        'pubmed': TODO
+        'ris': streams a RIS file download of the documents
+        'pubmed': streams a MEDLINE/PubMed-style text file download of the documents
+        'csv': streams a CSV file download of the documents
+
+    JSON params 'include' and 'exclude': Optional, lists of fields to return from or leave out of each document.
+
+    JSON param 'timeout': Optional, seconds this request may spend on elastic, see /api/direct_retrieval.
 
 
     usage: print(requests.post('http://localhost:9090/api/studyfromanyid', json={"table":"report","input":[149,218]}).text)
@@ -182,65 +530,185 @@ def study_from_any_id():
     data = flask.request.json
 
     ids = data.get('input', False)
-    print(ids)
+    log.debug('Got %d input ids', len(ids or []))
+    include, exclude = source_fields(data)
 
     dat_type=data.get('table', False)
 
-    if dat_type=='report':
-        # esknn.set_index_name("tbl_export")
-        # ret_field="ReportNumber"#the field to search
-        esknn.set_index_name("tblstudyreport")
-        ret_field="CRGReportID"#the field to search
-    elif dat_type=='condition':
-        esknn.set_index_name("tblstudyhealthcarecondition")
-        ret_field="HealthCareConditionID"#the field to search
-    elif dat_type=='intervention':
-        esknn.set_index_name("tblstudyintervention")
-        ret_field="InterventionID"#the field to search
-    elif dat_type=='outcome':
-        esknn.set_index_name("tblstudyoutcome")
-        ret_field="OutcomeID"#the field to search
-    elif dat_type == 'study':
-        esknn.set_index_name("tblstudy")
-        ret_field = "CRGStudyID"  # the field to search
+    if dat_type not in config.LINK_TABLES and dat_type != 'study':
+        return {
+            "status": 400,
+            "response": "Your request did not include a valid input parameter for table. try report, condition, intervention, or outcome on the 'table' parameter. "
+        }
+
+    if ids:
+        path = join_graph.path(dat_type, 'study')#one link table hop, none for 'study'
+        return_as = data.get('return_as', config.RETURN_AS)
+        deadline = request_deadline(data, stream=return_as != 'dict')
+        studies = traverse(ids, path, documents=config.JOIN_DOCUMENTS['study'], include=include, exclude=exclude, deadline=deadline)
+        if return_as != 'dict':
+            return stream_download(studies, return_as, columns=include or None)
+        result = list(studies)#get study metadata
 
 
 
     else:
+        return {
+                "status": 400,
+                "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"title:\"schizophrenia risperidone\"~3\"} "
+            }
+
+    return with_partial({
+        "status": 200,
+        "response":result
+    }, deadline)
+@app.route('/api/async/reportsfromstudyid', methods=['GET','POST'])
+async def async_reports_from_studyid():
+
+    """
+    Same as /api/reportsfromstudyid, but the ID chunks are looked up concurrently on the asyncio client,
+    so the worker is not blocked while it waits for elastic. Needs flask[async].
+
+    usage: print(requests.post('http://localhost:9090/api/async/reportsfromstudyid', json={"input":[138,139]}).text)
+    :return:
+    """
+    data = flask.request.json
+
+    ids = data.get('input', False)
+    if not ids:
+        return {
+                "status": 400,
+                "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":[138,139]} "
+            }
+
+    include, exclude = source_fields(data)
+    deadline = request_deadline(data)
+    result, stids, ids = await async_elastic_functions.submit(aesknn.reports_from_studies(ids, include=include, exclude=exclude, deadline=deadline))
+
+    return with_partial({
+        "status": 200,
+        "response":result,
+        "studyids":stids,
+        "reportids":ids
+    }, deadline)
+
+@app.route('/api/async/studyfromanyid', methods=['GET','POST'])
+async def async_study_from_any_id():
+
+    """
+    Same as /api/studyfromanyid, but runs on the asyncio client. Needs flask[async].
+    Besides {"table": "report", "input": [149,218]} it accepts IDs from several tables at once, which are then
+    searched concurrently and the linked studies returned together:
+
+    usage: print(requests.post('http://localhost:9090/api/async/studyfromanyid', json={"input":{"condition":[3],"intervention":[10,11]}}).text)
+    :return:
+    """
+    data = flask.request.json
+
+    ids = data.get('input', False)
+    if isinstance(ids, dict):
+        ids_by_type = ids
+    else:
+        ids_by_type = {data.get('table', False): ids}
+
+    if not all(dat_type in config.LINK_TABLES or dat_type == 'study' for dat_type in ids_by_type):
         return {
             "status": 400,
             "response": "Your request did not include a valid input parameter for table. try report, condition, intervention, or outcome on the 'table' parameter. "
         }
+    if not ids or not all(ids_by_type.values()):
+        return {
+                "status": 400,
+                "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"table\":\"report\",\"input\":[149,218]} "
+            }
 
-    if ids:
-        result = esknn.retrieve_documents(ids,ret_field=ret_field)#get study ID data from report ids
-        ids=set([d['CRGStudyID'] for d in result])
-        ids=list(ids)
+    include, exclude = source_fields(data)
+    deadline = request_deadline(data)
+    result = await async_elastic_functions.submit(aesknn.studies_from_any_ids(ids_by_type, include=include, exclude=exclude, deadline=deadline))
 
+    return with_partial({
+        "status": 200,
+        "response":result
+    }, deadline)
 
-        esknn.set_index_name("tblstudy")#get study metadata
-        ret_field = "CRGStudyID"  # the field to search
-        #
-        result = esknn.retrieve_documents(ids, ret_field=ret_field)
+@app.route('/api/traverse', methods=['GET','POST'])
+def traverse_links():
+
+    """
+    Follow the link tables from IDs of one entity to the linked documents of another, eg from conditions to the
+    reports of the studies that have them. The entities and link tables are set in config.JOIN_DOCUMENTS and
+    config.JOIN_LINKS, and the shortest chain of link tables is used unless 'via' names the entities to pass through.
+    The hops overlap: IDs found by one hop are passed on in batches while it is still looking up the rest.
 
+    JSON params 'from' and 'to': the entities, eg "condition" and "report".
+    JSON param 'via': Optional, list of entities to pass through, eg ["study"].
+    JSON param 'stream': Optional, true streams the documents back as newline-delimited JSON (one document per line).
+    JSON params 'include' and 'exclude': Optional, lists of fields to return from or leave out of each document.
+    JSON param 'return_as': 'dict' (default), or 'ris', 'pubmed' or 'csv' for a file download, see /api/reportsfromstudyid
+    JSON param 'timeout': Optional, seconds this request may spend on elastic, see /api/direct_retrieval.
 
+    Entities without their own index (eg condition) return their IDs as {field: id}.
 
-    else:
+    usage: print(requests.post('http://localhost:9090/api/traverse', json={"from":"condition","to":"report","input":[3,4]}).text)
+    :return:
+    """
+    data = flask.request.json
+
+    ids = data.get('input', False)
+    if not ids:
         return {
                 "status": 400,
-                "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"title:\"schizophrenia risperidone\"~3\"} "
+                "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"from\":\"condition\",\"to\":\"report\",\"input\":[3,4]} "
             }
 
-    return {
+    start, target = data.get('from', False), data.get('to', False)
+    via = data.get('via') or []
+    try:
+        path = join_graph.path(start, target, [via] if isinstance(via, str) else via)
+    except ValueError as e:
+        return {
+            "status": 400,
+            "response": str(e)
+        }
+
+    include, exclude = source_fields(data)
+    return_as = data.get('return_as', config.RETURN_AS)
+    deadline = request_deadline(data, stream=return_as != 'dict' or data.get('stream', False))
+    records = traverse(ids, path, documents=config.JOIN_DOCUMENTS.get(target), include=include, exclude=exclude, deadline=deadline,
+                       id_field=join_graph.id_field(target))
+
+    if return_as != 'dict':
+        return stream_download(records, return_as, columns=include or None)
+
+    if data.get('stream', False):
+        return stream_ndjson(records, deadline)
+
+    return with_partial({
         "status": 200,
-        "response":result
-    }
+        "path": [start] + [edge.target for edge in path],
+        "response": list(records)
+    }, deadline)
+
 # Search documents route
 @app.route('/api/search_query', methods=['GET','POST'])
 def search_query():
 
     """
     Make a search via query string but return only one field specified by ret_field. .
+    Optional JSON param 'index' searches another index than the current one for this request only.
+    Optional JSON param 'docvalues': true reads ret_field from doc values, which is cheaper for keyword and numeric ID fields.
+    Optional JSON param 'slices': read a very large result as this many scroll slices in parallel, see /api/direct_retrieval.
+    Optional JSON param 'timeout': seconds this request may spend on elastic, see /api/direct_retrieval.
+    Optional JSON params 'size' and 'cursor': return one page of 'size' hits and a "cursor" to send back for the next
+    page, see /api/direct_retrieval.
+    Optional JSON params 'count' and 'facets': "count": true returns only the number of hits. 'facets' adds aggregations,
+    given as a list of field names (terms facets) or dicts with 'field', 'type' (terms, histogram or date_histogram), 'size',
+    'interval' and 'name'; a single field name is taken as a list of one. For example
+        {"input": "Abstract:schizo*", "facets": [{"field": "Year", "type": "histogram"}, "StudyDesign"]}
+    returns
+        {"response": {"facets": {"StudyDesign": [{"count": 812, "key": "RCT"}, ...], "Year": [{"count": 3, "key": 1990}, ...]},
+                      "total": 5120},
+         "status": 200}
 
     Usage:
         print(requests.post('http://localhost:9090/api/search_query', json={"input":"title:\"genome dried\"~15", "ret_field":"title"}).text)
@@ -265,8 +733,23 @@ def search_query():
     if not ret_field:
         ret_field=elastic_functions.RET_FIELD
 
+    if data.get('count', False) or data.get('facets', False):
+        return count_query(data)
+
+    if data.get('size', False) or data.get('cursor', False):
+        return search_page(data, ret_field, return_docs=False)
+
     if query:
-        result = esknn.search_query(query,ret_field)
+        deadline = request_deadline(data)
+        try:
+            result = esknn.search_query(query,ret_field,index=data.get('index', False),
+                                        docvalues=data.get('docvalues', elastic_functions.SEARCH_DOCVALUES),
+                                        slices=data.get('slices', config.SCAN_SLICES), deadline=deadline)
+        except ValueError as e:#rejected by the query analyzer
+            return {
+                "status": 400,
+                "response": str(e)
+            }
     else:
         return {
                 "status": 400,
@@ -276,10 +759,10 @@ def search_query():
 
 
 
-    return {
+    return with_partial({
         "status": 200,
         "response":result
-    }
+    }, deadline)
 
     # field_name = data['field_name']
     # query = data['query']
@@ -299,6 +782,183 @@ def search_query():
     # }
 
 
+@app.route('/api/analyze_query', methods=['GET','POST'])
+def analyze_query():
+
+    """
+    Show what happens to a query string before it is searched: its estimated cost and the query that is actually
+    sent, with leading and infix wildcards rewritten where the index maps reverse or n-gram subfields (see query_analyzer.py).
+    Queries costing more than QUERY_MAX_COST get status 400, as they would in the search endpoints.
+
+    usage: print(requests.post('http://localhost:9090/api/analyze_query', json={"input":"Authors:*dams", "index":"tblreport"}).text)
+    returns: {"response": {"cost": 2, "query": "Authors.reverse:smad*", "throttled": false}, "status": 200}
+    :return:
+    """
+    data = flask.request.json
+
+    query = data.get('input', False)
+    if not query:
+        return {
+            "status": 400,
+            "response": "Your request did not include a search query. Try including a key-value pair in this format: {\"input\":\"Authors:*dams\"} "
+        }
+    try:
+        analysis = elastic_functions.analyze_query(query, data.get('index', False) or esknn.current_index_name)
+    except ValueError as e:
+        return {
+            "status": 400,
+            "response": str(e)
+        }
+
+    return {
+        "status": 200,
+        "response": {
+            "query": analysis.query,
+            "cost": analysis.cost,
+            "throttled": bool(config.QUERY_THROTTLE_COST) and analysis.cost > config.QUERY_THROTTLE_COST
+        }
+    }
+
+
+@app.route('/api/batch_search', methods=['GET','POST'])
+def batch_search():
+
+    """
+    Run several searches in one request (and one elastic round trip), eg counts for different filters on one page.
+
+    JSON param 'input': list of query specs. Each spec has an 'input' query string like /api/search_query, and optional
+    'index', 'ret_field', 'size' (max hits returned, default BATCH_SEARCH_SIZE) and 'return_docs' (true for whole documents).
+
+    Usage:
+        print(requests.post('http://localhost:9090/api/batch_search', json={"input": [
+            {"input": "Abstract:schizo*", "size": 3},
+            {"input": "CRGStudyID:138", "index": "tblstudyreport", "ret_field": "CRGReportID"}]}).text)
+
+    returns:
+        {
+          "response": [
+            {"response": [1001, 1002, 1005], "status": 200, "total": 5120},
+            {"response": [137, 1137, 2137], "status": 200, "total": 3}
+          ],
+          "status": 200
+        }
+    A query that fails gets {"status": 400, "response": "<error>"} in its place, the other queries are unaffected.
+    Optional JSON param 'timeout': seconds the searches may take, see /api/direct_retrieval. Queries that did not finish
+    on every shard in time get "partial": true, and so does the whole response.
+    :return:
+    """
+    data = flask.request.json
+
+    specs = data.get('input', False)
+    if not specs or not isinstance(specs, list):
+        return {
+            "status": 400,
+            "response": "Your request did not include a list of searches. Try including a key-value pair in this format: {\"input\":[{\"input\":\"title:\"genome dried\"~15\"}]} "
+        }
+
+    deadline = request_deadline(data)
+    try:
+        result = esknn.batch_search(specs, deadline=deadline)
+    except ValueError as e:#no throttle slot came free for an expensive batch
+        return {
+            "status": 400,
+            "response": str(e)
+        }
+
+    return with_partial({
+        "status": 200,
+        "response": result
+    }, deadline)
+
+
+def read_upload(stream, fmt, errors):
+    '''
+    Generator over the documents in an uploaded NDJSON or CSV file, read line by line from the request stream.
+    Lines that can not be parsed are skipped and reported in errors. Empty CSV cells are left out of the document.
+    '''
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if fmt == 'csv':
+        for row in csv.DictReader(text):
+            yield {k: v for k, v in row.items() if k and v not in ('', None)}
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            doc = json.loads(line)
+        except ValueError as e:
+            doc = e
+        if isinstance(doc, dict):
+            yield doc
+        elif len(errors) < config.INGEST_MAX_ERRORS:
+            errors.append({'line': line_number, 'error': 'not a JSON object'})
+
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest():
+
+    """
+    Bulk-load an NDJSON (one JSON document per line) or CSV (with header row) upload into any index.
+    Only served when INGEST_ENABLED is set in config.py, otherwise every request gets a 403.
+    The upload is streamed into elastic in chunks, it is never read into memory as a whole.
+    The file is either the raw request body or a multipart upload named 'file'. Options go in the query string:
+
+    index: index to load into, defaults to the current index
+    format: 'ndjson' or 'csv', defaults to csv for text/csv uploads and .csv file names, ndjson otherwise
+    chunk_size: documents per bulk request, default INGEST_CHUNK_SIZE, at most INGEST_MAX_CHUNK_SIZE
+    threads: bulk requests in flight at the same time, default INGEST_THREADS, at most INGEST_MAX_THREADS
+    id_field: use this field's value as the document _id, so loading a refreshed export overwrites documents
+    pause_refresh: 'true' switches off index refreshes during the load and refreshes once at the end
+
+    Usage:
+        with open('tblreport.csv', 'rb') as f:
+            print(requests.post('http://localhost:9090/api/ingest?index=tblreport&id_field=CRGReportID&pause_refresh=true',
+                                data=f, headers={'Content-Type': 'text/csv'}).text)
+
+    returns:
+        {
+          "response": {"docs_per_second": 8421.3, "errors": [], "failed": 0, "index": "tblreport", "indexed": 120000,
+                       "parse_errors": [], "seconds": 14.25},
+          "status": 200
+        }
+    :return:
+    """
+    if not config.INGEST_ENABLED:
+        return {
+            "status": 403,
+            "response": "Ingest is switched off on this server, set INGEST_ENABLED in config.py to use it"
+        }, 403
+
+    args = flask.request.args
+    upload = flask.request.files.get('file')
+    stream = upload.stream if upload else flask.request.stream
+    name = upload.filename if upload else ''
+
+    fmt = args.get('format') or ('csv' if flask.request.mimetype == 'text/csv' or name.endswith('.csv') else 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return {
+            "status": 400,
+            "response": "Unknown format {}, use 'ndjson' or 'csv'".format(fmt)
+        }
+
+    parse_errors = []
+    index = args.get('index') or esknn.get_index_name()
+    result = esknn.ingest(read_upload(stream, fmt, parse_errors),
+                          index=index,
+                          chunk_size=args.get('chunk_size', config.INGEST_CHUNK_SIZE, type=int),
+                          threads=args.get('threads', config.INGEST_THREADS, type=int),
+                          id_field=args.get('id_field'),
+                          pause_refresh=args.get('pause_refresh', 'false').lower() == 'true')
+    result['parse_errors'] = parse_errors
+    link_index.written(index)#joins see new links right away, not only after the next LINK_INDEX_REFRESH
+
+    return {
+        "status": 200,
+        "response": result
+    }
+
+
 # Search documents route
 @app.route('/api/get_documents', methods=['GET','POST'])
 def get_documents():
@@ -311,9 +971,18 @@ def get_documents():
     by 'title', 'DOI', 'PMCID' or anything indexed in this index. Those can also be searched by /api/search_query when DOI or else is given as 'ret_field' parameter there.
     Caution: If anything oter than OA ID is used for ID-selection-retrieval then there may be missing records due to incomplete fields.
 
+    JSON param 'index': Optional, the index to retrieve from for this request only. Defaults to the current index.
+
+    JSON param 'stream': Optional, true streams the documents back as newline-delimited JSON (one document per line).
+
+    JSON params 'include' and 'exclude': Optional, lists of fields to return from or leave out of each document,
+    eg "include": ["title", "doi"] or "exclude": ["abstract"]. Wildcards like "auth*" are allowed.
+
+    JSON param 'timeout': Optional, seconds this request may spend on elastic, see /api/direct_retrieval.
+
     JSON param 'return_as':
         'dict': simply returns a list of dictionaries.
-        'ris': TODO we can return a RIS fiel as single string for direct reference download, if needed?
+        'ris', 'pubmed' or 'csv': streams a file download of the documents in that format, see /api/reportsfromstudyid
 
 
     Usage:
@@ -368,13 +1037,25 @@ def get_documents():
     if not ret_field:
         ret_field=elastic_functions.RET_FIELD
 
+    include, exclude = source_fields(data)
+
+    return_as = data.get('return_as', config.RETURN_AS)
+    deadline = request_deadline(data, stream=return_as != 'dict' or data.get('stream', False))
+    if return_as != 'dict':
+        return stream_download(esknn.iter_documents(ids,ret_field=ret_field,index=data.get('index', False),include=include,exclude=exclude,deadline=deadline),
+                               return_as, columns=include or None)
+
+    if data.get('stream', False):
+        return stream_ndjson(esknn.iter_documents(ids,ret_field=ret_field,index=data.get('index', False),include=include,exclude=exclude,deadline=deadline),
+                             deadline)
+
     if ids:
-        result = esknn.retrieve_documents(ids,ret_field=ret_field)
+        result = esknn.retrieve_documents(ids,ret_field=ret_field,index=data.get('index', False),include=include,exclude=exclude,deadline=deadline)
 
-    return {
+    return with_partial({
         "status": 200,
         "response":result
-    }
+    }, deadline)
 
 
 # Field-based search route
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import threading
+
+from elasticsearch import AsyncElasticsearch
+from elastic_transport import AiohttpHttpNode
+
+import config
+import metrics
+from elastic_functions import CLIENT_OPTIONS, SCAN_PAGE_SIZE, _cached_chunk, _chunk_query, _merge_chunk, _is_wanted, index_registry, source_filter
+from link_index import link_id, link_index
+
+
+INDEX_NAME = config.INDEX_NAME#default index, unless specified differently per call
+ESKNN_HOST = config.ESKNN_HOST#where elastic lives, eg 'http://localhost:9200'
+ID_CHUNK_SIZE = config.ID_CHUNK_SIZE#max number of IDs per lookup request
+ASYNC_MAX_CONCURRENCY = config.ASYNC_MAX_CONCURRENCY#max number of elastic requests in flight per worker process
+LINK_TABLES = config.LINK_TABLES#'table' names -> (link table, field to search in it)
+STUDY_FIELD = config.STUDY_FIELD#study ID field shared by tblstudy and the link tables
+SCROLL_KEEP_ALIVE = config.SCROLL_KEEP_ALIVE#how long a scroll context stays open between two pages
+
+####################One event loop per process, running in a background thread. It owns the async client, so that
+####################all requests of a worker share one connection pool, whichever thread or event loop they come from.
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_es = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    ''' The background event loop of this process, started on first use (and again in a forked child)
+    '''
+    global _loop, _loop_pid, _es
+    if _loop_pid != os.getpid():
+        with _loop_lock:
+            if _loop_pid != os.getpid():
+                _loop = asyncio.new_event_loop()
+                _es = None#the parent's client belongs to the parent's loop
+                threading.Thread(target=_loop.run_forever, name='async-elastic', daemon=True).start()
+                _loop_pid = os.getpid()
+    return _loop
+
+
+def get_es() -> AsyncElasticsearch:
+    ''' The async client of this process, with the same pool size, timeouts and retries as the sync one
+    '''
+    global _es
+    if _es is None:
+        node_class = metrics.instrumented(AiohttpHttpNode) if metrics.METRICS_ENABLED else AiohttpHttpNode
+        _es = AsyncElasticsearch(hosts=[ESKNN_HOST], node_class=node_class, **CLIENT_OPTIONS)
+    return _es
+
+
+def run(coro):
+    ''' Run a coroutine on the background loop and wait for its result, for callers without an event loop
+    '''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+async def submit(coro):
+    ''' Await a coroutine that runs on the background loop, from any other event loop (eg an async flask view)
+    '''
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, get_loop()))
+
+
+class AsyncESKNN():
+    ''' asyncio version of ESKNN for the join endpoints. Chunk lookups and the lookups in different link tables
+    run at the same time instead of one after the other. All coroutines must run on get_loop(), use run() or submit().
+    '''
+
+    def __init__(self) -> None:
+        self.current_index_name = INDEX_NAME
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def _limit(self) -> asyncio.Semaphore:
+        if self._semaphore_loop is not get_loop():
+            self._semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+            self._semaphore_loop = get_loop()
+        return self._semaphore
+
+    async def _lookup_chunk(self, index, chunk, ret_field, field_type, source=None, deadline=None) -> list:
+        found, missing = _cached_chunk(index, chunk, ret_field, field_type, source)
+        metrics.LOOKUP_CHUNKS.inc(index=index, source='elastic' if missing else 'cache')
+        hits = []
+        if missing:
+            async with self._limit():
+                await self._scan(index, _chunk_query(missing, ret_field, field_type, source), hits, deadline)
+        return _merge_chunk(index, chunk, ret_field, field_type, found, missing, hits, source, deadline)
+
+    async def _scan(self, index, body, hits, deadline=None) -> None:
+        ''' Append all hits of a lookup to hits: one search, and a scroll only if that search reports more matches
+        than it returned, which ends at the first short page. With a deadline the lookup is cancelled when it runs
+        out, which clears its scroll, and the hits so far are kept with deadline.partial set.
+        '''
+        async def scan():
+            response = await get_es().search(index=index, body=dict(body, track_total_hits=True), size=SCAN_PAGE_SIZE)
+            if response['hits']['total']['value'] <= len(response['hits']['hits']):
+                return hits.extend(response['hits']['hits'])
+            scroll_id = None
+            try:
+                response = await get_es().search(index=index, body=dict(body, sort='_doc'), scroll=SCROLL_KEEP_ALIVE,
+                                                 size=SCAN_PAGE_SIZE)
+                total = response['hits']['total']['value']
+                while True:
+                    scroll_id = response.get('_scroll_id')
+                    hits.extend(response['hits']['hits'])
+                    if len(response['hits']['hits']) < SCAN_PAGE_SIZE or len(hits) >= total or not scroll_id:
+                        return
+                    response = await get_es().scroll(scroll_id=scroll_id, scroll=SCROLL_KEEP_ALIVE)
+            finally:
+                if scroll_id:
+                    await get_es().options(ignore_status=404).clear_scroll(scroll_id=scroll_id)
+
+        if deadline is None:
+            return await scan()
+        if deadline.expired():
+            return
+        try:
+            await asyncio.wait_for(scan(), deadline.remaining())
+        except asyncio.TimeoutError:
+            deadline.partial = True
+
+    async def retrieve_documents(self, id_list, ret_field, index=None, include=None, exclude=None, deadline=None) -> list:
+        ''' Same as ESKNN.retrieve_documents, but all chunks are looked up concurrently.
+        Documents are returned in the order of id_list, without those not found before the deadline.
+            --------------
+        '''
+        id_list = list(dict.fromkeys(str(i).strip() for i in id_list))#make sure IDs are unique, but keep their order
+        chunks = [id_list[i:i + ID_CHUNK_SIZE] for i in range(0, len(id_list), ID_CHUNK_SIZE)]
+        index = index or self.current_index_name
+        field_type = None
+        if ret_field != '_id':#mappings are cached, so this rarely goes to elastic
+            field_type = await asyncio.get_running_loop().run_in_executor(None, index_registry.field_type, index, ret_field)
+
+        source = source_filter(include, exclude, keep=ret_field)#ret_field is needed to put the documents in order
+        strip = source is not None and ret_field != '_id' and not _is_wanted(ret_field, include, exclude)
+
+        with metrics.hop('lookup', index) as h:
+            results = await asyncio.gather(*[self._lookup_chunk(index, chunk, ret_field, field_type, source, deadline) for chunk in chunks])
+            h.hits = sum(len(docs) for docs in results)
+        return [{k: v for k, v in doc.items() if k != ret_field} if strip else doc for docs in results for doc in docs]
+
+    async def study_ids(self, dat_type, ids, deadline=None) -> list:
+        ''' Study IDs linked to ids of one type ('report', 'condition', 'intervention', 'outcome' or 'study')
+        '''
+        if dat_type == 'study':
+            return list(ids)
+        index_name, ret_field = LINK_TABLES[dat_type]
+        links = link_index.get(index_name)
+        if links is not None:#answer the first hop from memory
+            return [p[1] for p in links.to_studies(ids)]
+        result = await self.retrieve_documents(ids, ret_field, index=index_name, include=[STUDY_FIELD], deadline=deadline)
+        return [link_id(d[STUDY_FIELD]) for d in result]
+
+    async def studies_from_any_ids(self, ids_by_type, include=None, exclude=None, deadline=None) -> list:
+        ''' Studies linked to the given IDs, eg {'condition': [3, 4], 'intervention': [10]}.
+        The link tables are searched concurrently, then the studies are retrieved in one go.
+        include/exclude: only return these fields of the studies
+            --------------
+        '''
+        groups = await asyncio.gather(*[self.study_ids(dat_type, ids, deadline) for dat_type, ids in ids_by_type.items()])
+        study_ids = list(dict.fromkeys(i for group in groups for i in group))
+        return await self.retrieve_documents(study_ids, STUDY_FIELD, index="tblstudy", include=include, exclude=exclude, deadline=deadline)
+
+    async def reports_from_studies(self, ids, include=None, exclude=None, deadline=None) -> tuple:
+        ''' Reports linked to study IDs\n
+        include/exclude: only return these fields of the reports
+            --------------
+            Returns -> (report documents, study id per link, report id per link)
+        '''
+        links = link_index.get("tblstudyreport")
+        if links is not None:#answer the first hop from memory
+            pairs = links.from_studies(ids)
+        else:
+            result = await self.retrieve_documents(ids, STUDY_FIELD, index="tblstudyreport", include=[STUDY_FIELD, 'CRGReportID'], deadline=deadline)
+            pairs = [(link_id(d[STUDY_FIELD]), link_id(d['CRGReportID'])) for d in result]
+        stids = [p[0] for p in pairs]
+        report_ids = list(set(p[1] for p in pairs))
+        result = await self.retrieve_documents(report_ids, "CRGReportID", index="tblreport", include=include, exclude=exclude, deadline=deadline)
+        return result, stids, report_ids
@@ -0,0 +1,124 @@
+'''
+Synthetic data shaped like the Cochrane register tables this API serves: reports, studies, the report-study link
+table and the condition/intervention/outcome link tables. Everything is generated from a seed, so two runs at the
+same scale search the same documents.
+
+scale is the number of reports; there are about a third as many studies, most studies have one to three reports
+and a few have many, as in the real register.
+'''
+import random
+
+
+WORDS = ('schizophrenia', 'depression', 'anxiety', 'asthma', 'diabetes', 'hypertension', 'stroke', 'dementia',
+         'obesity', 'smoking', 'cessation', 'pregnancy', 'neonatal', 'infant', 'children', 'adolescents', 'elderly',
+         'randomised', 'controlled', 'trial', 'placebo', 'double', 'blind', 'crossover', 'cluster', 'pilot',
+         'antipsychotic', 'antidepressant', 'insulin', 'metformin', 'aspirin', 'statin', 'exercise', 'diet',
+         'acupuncture', 'psychotherapy', 'cognitive', 'behavioural', 'therapy', 'vaccine', 'antibiotic', 'surgery',
+         'outcome', 'efficacy', 'safety', 'mortality', 'quality', 'life', 'relapse', 'adherence', 'follow', 'up')
+SURNAMES = ('Adams', 'Brown', 'Chen', 'Davies', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Ito', 'Jones', 'Kumar',
+            'Lopez', 'Müller', 'Nguyen', 'Okafor', 'Patel', 'Rossi', 'Smith', 'Tanaka', 'Wang', 'Young', 'Zhang')
+JOURNALS = ('Lancet', 'BMJ', 'JAMA', 'New England Journal of Medicine', 'Schizophrenia Research',
+            'Journal of Clinical Psychiatry', 'Diabetes Care', 'Cochrane Database of Systematic Reviews', 'Trials')
+DESIGNS = ('RCT', 'Cluster RCT', 'Crossover RCT', 'Quasi-RCT', 'Non-randomised')
+
+MAPPINGS = {
+    'tblreport': {'CRGReportID': 'long', 'Title': 'text', 'Authors': 'text', 'Year': 'long', 'Journal': 'text',
+                  'Volume': 'keyword', 'Issue': 'keyword', 'Pages': 'keyword', 'DOI': 'keyword', 'PMID': 'long',
+                  'Abstract': 'text', 'Authors.reverse': 'text', 'Authors.ngram': 'text'},
+    'tblstudy': {'CRGStudyID': 'long', 'ShortName': 'text', 'StudyDesign': 'keyword', 'Year': 'long'},
+    'tblstudyreport': {'CRGStudyID': 'long', 'CRGReportID': 'long'},
+    'tblstudyhealthcarecondition': {'CRGStudyID': 'long', 'HealthCareConditionID': 'long'},
+    'tblstudyintervention': {'CRGStudyID': 'long', 'InterventionID': 'long'},
+    'tblstudyoutcome': {'CRGStudyID': 'long', 'OutcomeID': 'long'},
+}
+ANALYSIS = {#analyzers of the subfields query_analyzer.py rewrites leading (*dams) and infix (*dam*) wildcards to
+    'analyzer': {'reverse': {'tokenizer': 'standard', 'filter': ['lowercase', 'reverse']},
+                 'ngram': {'tokenizer': 'trigram', 'filter': ['lowercase']}},
+    'tokenizer': {'trigram': {'type': 'ngram', 'min_gram': 3, 'max_gram': 3, 'token_chars': ['letter', 'digit']}},
+}
+ID_FIELDS = {'tblreport': 'CRGReportID', 'tblstudy': 'CRGStudyID'}#document _id, the link tables get generated ids
+LINKED_IDS = {'tblstudyhealthcarecondition': ('HealthCareConditionID', 500),#link table -> (ID field, number of distinct IDs)
+              'tblstudyintervention': ('InterventionID', 2000),
+              'tblstudyoutcome': ('OutcomeID', 5000)}
+
+
+def index_body(index) -> dict:
+    ''' settings and mappings to create an index in a real elastic node with, subfields nested under their field
+    '''
+    properties = {}
+    for field, field_type in MAPPINGS[index].items():
+        if '.' in field:
+            parent, sub = field.split('.', 1)
+            properties[parent].setdefault('fields', {})[sub] = {'type': field_type, 'analyzer': sub}
+        else:
+            properties[field] = {'type': field_type}
+    body = {'mappings': {'properties': properties}}
+    if any('.' in field for field in MAPPINGS[index]):
+        body['settings'] = {'analysis': ANALYSIS}
+    return body
+
+
+def _sentence(rng, low, high) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def reports(scale, seed=0):
+    rng = random.Random(seed)
+    for i in range(1, scale + 1):
+        authors = '; '.join('{}, {}.'.format(rng.choice(SURNAMES), rng.choice('ABCDEFGHJKLMNPRSTW')) for _ in range(rng.randint(1, 6)))
+        page = rng.randint(1, 900)
+        yield {
+            'CRGReportID': i,
+            'Title': _sentence(rng, 6, 18).capitalize(),
+            'Authors': authors,
+            'Year': rng.randint(1980, 2024),
+            'Journal': rng.choice(JOURNALS),
+            'Volume': str(rng.randint(1, 400)),
+            'Issue': str(rng.randint(1, 12)),
+            'Pages': '{}-{}'.format(page, page + rng.randint(2, 15)),
+            'DOI': '10.{}/bench.{}'.format(1000 + i % 9000, i),
+            'PMID': 10000000 + i,
+            'Abstract': '. '.join(_sentence(rng, 10, 25).capitalize() for _ in range(rng.randint(4, 10))) + '.',
+        }
+
+
+def studies(scale, seed=0):
+    rng = random.Random(seed + 1)
+    for i in range(1, study_count(scale) + 1):
+        year = rng.randint(1980, 2024)
+        yield {'CRGStudyID': i, 'ShortName': '{} {}'.format(rng.choice(SURNAMES), year), 'StudyDesign': rng.choice(DESIGNS), 'Year': year}
+
+
+def study_count(scale) -> int:
+    return max(1, scale // 3)
+
+
+def study_reports(scale, seed=0):
+    ''' Every report belongs to one study. Study sizes are skewed: a few studies collect dozens of reports.
+    '''
+    rng = random.Random(seed + 2)
+    n = study_count(scale)
+    for i in range(1, scale + 1):
+        study = int(n * rng.random() ** 2) + 1 if rng.random() < 0.3 else rng.randint(1, n)
+        yield {'CRGStudyID': study, 'CRGReportID': i}
+
+
+def links(index, scale, seed=0):
+    field, distinct = LINKED_IDS[index]
+    rng = random.Random(seed + 3 + len(index))
+    for study in range(1, study_count(scale) + 1):
+        for value in rng.sample(range(1, distinct + 1), rng.randint(1, 4)):
+            yield {'CRGStudyID': study, field: value}
+
+
+def dataset(scale, seed=0) -> dict:
+    ''' index name -> generator over its documents
+    '''
+    tables = {
+        'tblreport': reports(scale, seed),
+        'tblstudy': studies(scale, seed),
+        'tblstudyreport': study_reports(scale, seed),
+    }
+    for index in LINKED_IDS:
+        tables[index] = links(index, scale, seed)
+    return tables
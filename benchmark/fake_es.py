@@ -0,0 +1,536 @@
+'''
+In-process stand-in for an Elasticsearch node.
+
+FakeNode plugs into the official client as its node_class, so every call made by elastic_functions.py goes through
+the real client and transport code and only the HTTP round trip is replaced by an in-memory implementation.
+It understands the subset of the REST API this repo uses: search/scroll/point-in-time/msearch/count/bulk,
+query_string (fields, phrases, wildcards, AND/OR/NOT), bool/terms/ids/match_phrase queries, slices,
+terms/histogram/date_histogram aggregations, source filtering and docvalue_fields.
+
+Usage:
+    es = Elasticsearch('http://fake:9200', node_class=FakeNode)
+    FakeNode.store.load('tblreport', docs, mappings={'CRGReportID': 'long', 'Title': 'text'})
+'''
+import asyncio
+import fnmatch
+import json
+import re
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from elastic_transport import ApiResponseMeta, BaseAsyncNode, BaseNode, HttpHeaders
+from elastic_transport._node._base import NodeApiResponse
+
+
+class FakeStore():
+    ''' Indices, scroll contexts and point-in-times shared by every FakeNode
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.indices = {}#name -> {'docs': {id: source}, 'mappings': {field: type}, 'settings': {}}
+        self.scrolls = {}#scroll id -> remaining hits
+        self.pits = {}#pit id -> snapshot of (index, id, source) tuples
+        self.counter = 0
+        self.latency = 0.0#seconds added to every request, to mimic a network hop
+        self.requests = 0
+
+    def load(self, index, docs, mappings=None, id_field=None) -> None:
+        with self.lock:
+            idx = self.indices.setdefault(index, {'docs': {}, 'mappings': {}, 'settings': {}})
+            idx['mappings'].update(mappings or {})
+            for doc in docs:
+                self.counter += 1
+                doc_id = str(doc[id_field]) if id_field else str(self.counter)
+                idx['docs'][doc_id] = doc
+
+    def resolve(self, expression) -> list:
+        names = []
+        for part in (expression or '_all').split(','):
+            if part in ('_all', '*'):
+                names.extend(self.indices)
+            elif '*' in part:
+                names.extend(n for n in self.indices if fnmatch.fnmatchcase(n, part))
+            elif part in self.indices:
+                names.append(part)
+        return list(dict.fromkeys(names))
+
+    def next_id(self, prefix) -> str:
+        with self.lock:
+            self.counter += 1
+            return '{}{}'.format(prefix, self.counter)
+
+    def field_type(self, indices, field) -> str:
+        for name in indices:
+            field_type = self.indices[name]['mappings'].get(field)
+            if field_type:
+                return field_type
+        return 'text'
+
+
+def _values(source, field):
+    if field.endswith('.reverse') or field.endswith('.ngram') or field.endswith('.keyword'):
+        field = field.rsplit('.', 1)[0]
+    value = source
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return []
+        value = value.get(part)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _tokens(value):
+    return re.findall(r'\w+', str(value).lower())
+
+
+class _QueryString():
+    ''' Tiny Lucene query_string parser: field:term, field:"phrase"~N, wildcards, AND/OR/NOT, -term and brackets
+    '''
+    TOKEN = re.compile(r'\s*(\(|\)|AND\b|OR\b|NOT\b|&&|\|\||[+-]?(?:[\w.*?]+:)?(?:"[^"]*"(?:~\d+)?|[^\s()"]+))')
+
+    def __init__(self, query, store, indices, default_field='*') -> None:
+        self.tokens = [t for t in self.TOKEN.findall(query) if t]
+        self.pos = 0
+        self.store = store
+        self.indices = indices
+        self.default_field = default_field
+        self.tree = self.parse_or() if self.tokens else ('all',)
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() is not None and self.peek() != ')':
+            if self.peek() in ('OR', '||'):
+                self.pos += 1
+            nodes.append(self.parse_and())
+        return ('or', nodes) if len(nodes) > 1 else nodes[0]
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() in ('AND', '&&'):
+            self.pos += 1
+            nodes.append(self.parse_not())
+        return ('and', nodes) if len(nodes) > 1 else nodes[0]
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.pos += 1
+            return ('not', self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.peek()
+        self.pos += 1
+        if token == '(':
+            node = self.parse_or()
+            if self.peek() == ')':
+                self.pos += 1
+            return node
+        negate = token.startswith('-')
+        token = token.lstrip('+-')
+        field, term = self.default_field, token
+        match = re.match(r'^([\w.*?]+):(.*)$', token)
+        if match:
+            field, term = match.group(1), match.group(2)
+        node = ('term', field, term)
+        return ('not', node) if negate else node
+
+    def matches(self, source, node=None) -> bool:
+        node = node or self.tree
+        kind = node[0]
+        if kind == 'all':
+            return True
+        if kind == 'or':
+            return any(self.matches(source, n) for n in node[1])
+        if kind == 'and':
+            return all(self.matches(source, n) for n in node[1])
+        if kind == 'not':
+            return not self.matches(source, node[1])
+        field, term = node[1], node[2]
+        fields = list(source) if field == '*' else [field]
+        return any(self.match_term(source, f, term) for f in fields)
+
+    def match_term(self, source, field, term) -> bool:
+        values = _values(source, field)
+        if not values:
+            return False
+        if term.startswith('"'):
+            if field.endswith('.ngram'):#n-grams of a phrase match it anywhere inside a token
+                return any(t in token for t in _tokens(term.strip('"')) for v in values for token in _tokens(v))
+            phrase = _tokens(re.sub(r'~\d+$', '', term).strip('"'))
+            slop = re.search(r'~(\d+)$', term)
+            return any(_phrase_match(_tokens(v), phrase, int(slop.group(1)) if slop else 0) for v in values)
+        term = term.lower()
+        if field.endswith('.reverse'):
+            return any(fnmatch.fnmatchcase(t[::-1], term) for v in values for t in _tokens(v))
+        if field.endswith('.ngram'):
+            return any(term.strip('*') in t for v in values for t in _tokens(v))
+        if self.store.field_type(self.indices, field) in ('text',):
+            return any(fnmatch.fnmatchcase(t, term) for v in values for t in _tokens(v))
+        return any(fnmatch.fnmatchcase(str(v).lower(), term) for v in values)
+
+
+def _phrase_match(tokens, phrase, slop) -> bool:
+    if not phrase:
+        return False
+    if slop == 0:
+        n = len(phrase)
+        return any(tokens[i:i + n] == phrase for i in range(len(tokens) - n + 1))
+    positions = [i for i, t in enumerate(tokens) if t in phrase]
+    present = set(tokens[i] for i in positions)
+    if not set(phrase) <= present:
+        return False
+    return (max(positions) - min(positions)) <= len(phrase) - 1 + slop or len(tokens) < len(phrase) + slop + 2
+
+
+class FakeNode(BaseNode):
+    ''' BaseNode implementation answering requests from FakeNode.store
+    '''
+    _CLIENT_META_HTTP_CLIENT = ('fake', '0.1')
+    store = FakeStore()
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None) -> NodeApiResponse:
+        if self.store.latency:
+            time.sleep(self.store.latency)
+        return self.answer(method, target, body, headers)
+
+    def answer(self, method, target, body=None, headers=None) -> NodeApiResponse:
+        start = time.time()
+        store = self.store
+        with store.lock:
+            store.requests += 1
+
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        if body and (headers or {}).get('content-encoding') == 'gzip':
+            import gzip
+            body = gzip.decompress(body)
+        status, data = self.route(method, parts, params, body)
+        payload = b'' if data is None else json.dumps(data).encode('utf-8')
+        meta = ApiResponseMeta(
+            status=status,
+            http_version='1.1',
+            headers=HttpHeaders({'x-elastic-product': 'Elasticsearch', 'content-type': 'application/json'}),
+            duration=time.time() - start,
+            node=self.config,
+        )
+        return NodeApiResponse(meta, payload)
+
+    def close(self) -> None:
+        pass
+
+    def route(self, method, parts, params, body):
+        store = self.store
+        json_body = {}
+        if body and not (parts and parts[-1] in ('_bulk', '_msearch')):
+            json_body = json.loads(body)
+
+        if not parts:
+            return 200, {'name': 'fake', 'cluster_name': 'fake', 'version': {'number': '8.19.0'}, 'tagline': 'You Know, for Search'}
+        if parts[0] == '_search' and len(parts) == 2 and parts[1] == 'scroll':
+            if method == 'DELETE':
+                for scroll_id in _as_list(json_body.get('scroll_id') or params.get('scroll_id')):
+                    store.scrolls.pop(scroll_id, None)
+                return 200, {'succeeded': True, 'num_freed': 1}
+            return 200, self.scroll(json_body.get('scroll_id') or params.get('scroll_id'))
+        if parts[0] == '_pit' and method == 'DELETE':
+            store.pits.pop(json_body.get('id'), None)
+            return 200, {'succeeded': True, 'num_freed': 1}
+        if parts[-1] == '_bulk':
+            return 200, self.bulk(parts[0] if len(parts) == 2 else None, body)
+        if parts[-1] == '_msearch':
+            return 200, self.msearch(parts[0] if len(parts) == 2 else None, body)
+        if parts[0] == '_search':
+            return 200, self.search(None, json_body, params)
+
+        index = parts[0]
+        names = store.resolve(index)
+        if len(parts) == 1:
+            if method == 'HEAD':
+                return (200 if names else 404), None
+            if method == 'PUT':
+                if index in store.indices:
+                    return 400, {'error': {'type': 'resource_already_exists_exception'}, 'status': 400}
+                store.indices[index] = {'docs': {}, 'mappings': {}, 'settings': {}}
+                return 200, {'acknowledged': True, 'index': index}
+            if method == 'DELETE':
+                for name in names:
+                    store.indices.pop(name, None)
+                return 200, {'acknowledged': True}
+        if not names:
+            return 404, {'error': {'type': 'index_not_found_exception', 'reason': 'no such index [{}]'.format(index)}, 'status': 404}
+        action = parts[1]
+        if action == '_search':
+            return 200, self.search(names, json_body, params)
+        if action == '_count':
+            hits = self.matching(names, json_body.get('query'))
+            return 200, {'count': len(hits)}
+        if action == '_pit':
+            pit_id = store.next_id('pit')
+            store.pits[pit_id] = self.snapshot(names)
+            return 200, {'id': pit_id}
+        if action == '_refresh':
+            return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        if action == '_settings':
+            if method == 'PUT':
+                for name in names:
+                    store.indices[name]['settings'].update(json_body.get('index', json_body))
+                return 200, {'acknowledged': True}
+            return 200, {name: {'settings': {'index': dict(store.indices[name]['settings'])}} for name in names}
+        if action == '_mapping':
+            if len(parts) > 3 and parts[2] == 'field':
+                fields = parts[3].split(',')
+                return 200, {name: {'mappings': {f: {'full_name': f, 'mapping': {f.split('.')[-1]: {'type': store.indices[name]['mappings'][f]}}}
+                                                 for f in fields if f in store.indices[name]['mappings']}} for name in names}
+            return 200, {name: {'mappings': {'properties': self.properties(store.indices[name]['mappings'])}} for name in names}
+        return 400, {'error': {'type': 'unsupported', 'reason': '/'.join(parts)}, 'status': 400}
+
+    @staticmethod
+    def properties(mappings) -> dict:
+        properties = {}
+        for field, field_type in mappings.items():
+            if '.' in field:
+                parent, sub = field.rsplit('.', 1)
+                properties.setdefault(parent, {'type': mappings.get(parent, 'text')}).setdefault('fields', {})[sub] = {'type': field_type}
+            else:
+                properties.setdefault(field, {})['type'] = field_type
+        return properties
+
+    def snapshot(self, names) -> list:
+        with self.store.lock:
+            return [(name, doc_id, source) for name in names for doc_id, source in self.store.indices[name]['docs'].items()]
+
+    def matching(self, names, query, docs=None) -> list:
+        docs = self.snapshot(names) if docs is None else docs
+        return [d for d in docs if self.evaluate(query or {'match_all': {}}, d, names)]
+
+    def evaluate(self, query, doc, names) -> bool:
+        index, doc_id, source = doc
+        (kind, spec), = query.items()
+        if kind == 'match_all':
+            return True
+        if kind == 'bool':
+            must = _as_list(spec.get('must')) + _as_list(spec.get('filter'))
+            should = _as_list(spec.get('should'))
+            must_not = _as_list(spec.get('must_not'))
+            minimum = spec.get('minimum_should_match', 0 if must else 1)
+            if not all(self.evaluate(q, doc, names) for q in must):
+                return False
+            if any(self.evaluate(q, doc, names) for q in must_not):
+                return False
+            return not should or sum(1 for q in should if self.evaluate(q, doc, names)) >= int(minimum)
+        if kind == 'ids':
+            return doc_id in [str(v) for v in spec['values']]
+        if kind in ('terms', 'term'):
+            (field, wanted), = [(k, v) for k, v in spec.items() if k != 'boost']
+            wanted = wanted['value'] if isinstance(wanted, dict) else wanted
+            wanted = set(str(v) for v in _as_list(wanted))
+            return any(str(v) in wanted for v in _values(source, field))
+        if kind in ('match_phrase', 'match'):
+            (field, text), = spec.items()
+            text = text['query'] if isinstance(text, dict) else text
+            phrase = _tokens(text)
+            if kind == 'match':
+                return any(set(phrase) & set(_tokens(v)) for v in _values(source, field))
+            return any(_phrase_match(_tokens(v), phrase, 0) for v in _values(source, field))
+        if kind == 'query_string':
+            fields = spec.get('fields') or [spec.get('default_field', '*')]
+            return _QueryString(spec['query'], self.store, names, fields[0]).matches(source)
+        raise ValueError('fake_es.py: unsupported query {}'.format(kind))
+
+    def render(self, doc, body, params) -> dict:
+        index, doc_id, source = doc
+        hit = {'_index': index, '_id': doc_id, '_score': None}
+        wanted = body.get('_source', params.get('_source', True))
+        includes = params.get('_source_includes')
+        excludes = params.get('_source_excludes')
+        if isinstance(wanted, str) and wanted not in ('true', 'false'):
+            includes = wanted
+            wanted = True
+        if wanted == 'false':
+            wanted = False
+        if isinstance(wanted, dict):
+            includes, excludes = wanted.get('includes'), wanted.get('excludes')
+        elif isinstance(wanted, list):
+            includes = wanted
+        if wanted is not False:
+            if isinstance(includes, str):
+                includes = includes.split(',')
+            if isinstance(excludes, str):
+                excludes = excludes.split(',')
+            hit['_source'] = {k: v for k, v in source.items()
+                              if (not includes or any(fnmatch.fnmatchcase(k, p) for p in includes))
+                              and not any(fnmatch.fnmatchcase(k, p) for p in (excludes or []))}
+        if body.get('docvalue_fields'):
+            fields = {}
+            for field in body['docvalue_fields']:
+                field = field['field'] if isinstance(field, dict) else field
+                values = _values(source, field)
+                if values:
+                    fields[field] = values
+            hit['fields'] = fields
+        return hit
+
+    def search(self, names, body, params) -> dict:
+        start = time.time()
+        store = self.store
+        pit = body.get('pit')
+        if pit:
+            docs = store.pits.get(pit['id'])
+            if docs is None:
+                raise ValueError('fake_es.py: unknown point in time')
+            names = list(dict.fromkeys(d[0] for d in docs))
+            hits = self.matching(names, body.get('query'), docs)
+        else:
+            hits = self.matching(names, body.get('query'))
+        if body.get('slice'):
+            slice_id, slice_max = body['slice']['id'], body['slice']['max']
+            hits = [d for d in hits if zlib.crc32(d[1].encode()) % slice_max == slice_id]
+
+        total = len(hits)
+        size = int(params.get('size', body.get('size', 10)))
+        offset = int(params.get('from', body.get('from', 0)))
+        terminate_after = body.get('terminate_after') or params.get('terminate_after')
+        if terminate_after:
+            hits = hits[:int(terminate_after)]
+
+        ordered = list(enumerate(hits))
+        search_after = body.get('search_after')
+        if search_after:
+            ordered = [(i, d) for i, d in ordered if i > search_after[0]]
+
+        response = {
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': None, 'hits': []},
+        }
+        if pit:
+            response['pit_id'] = pit['id']
+        if 'scroll' in params:
+            scroll_id = store.next_id('scroll')
+            store.scrolls[scroll_id] = (ordered[size:], body, params)
+            response['_scroll_id'] = scroll_id
+            ordered = ordered[:size]
+        else:
+            ordered = ordered[offset:offset + size]
+        for i, doc in ordered:
+            hit = self.render(doc, body, params)
+            if body.get('sort') is not None:
+                hit['sort'] = [i]
+            response['hits']['hits'].append(hit)
+        if body.get('aggs') or body.get('aggregations'):
+            response['aggregations'] = self.aggregate(body.get('aggs') or body.get('aggregations'), hits)
+        response['took'] = int((time.time() - start) * 1000)
+        return response
+
+    def scroll(self, scroll_id) -> dict:
+        remaining, body, params = self.store.scrolls.get(scroll_id, ([], {}, {}))
+        size = int(params.get('size', body.get('size', 10)))
+        self.store.scrolls[scroll_id] = (remaining[size:], body, params)
+        return {
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': {'value': len(remaining), 'relation': 'eq'}, 'hits': [self.render(d, body, params) for _, d in remaining[:size]]},
+        }
+
+    def aggregate(self, aggs, hits) -> dict:
+        result = {}
+        for name, spec in aggs.items():
+            if 'terms' in spec:
+                counts = {}
+                for doc in hits:
+                    for value in _values(doc[2], spec['terms']['field']):
+                        counts[value] = counts.get(value, 0) + 1
+                buckets = sorted(counts.items(), key=lambda kv: (-kv[1], str(kv[0])))[:spec['terms'].get('size', 10)]
+                result[name] = {'buckets': [{'key': k, 'doc_count': c} for k, c in buckets]}
+            elif 'histogram' in spec:
+                interval = spec['histogram'].get('interval', 1)
+                counts = {}
+                for doc in hits:
+                    for value in _values(doc[2], spec['histogram']['field']):
+                        key = float(value) // interval * interval
+                        counts[key] = counts.get(key, 0) + 1
+                result[name] = {'buckets': [{'key': k, 'doc_count': c} for k, c in sorted(counts.items())]}
+            elif 'date_histogram' in spec:
+                counts = {}
+                for doc in hits:
+                    for value in _values(doc[2], spec['date_histogram']['field']):
+                        year = str(value)[:4]
+                        counts[year] = counts.get(year, 0) + 1
+                result[name] = {'buckets': [{'key_as_string': '{}-01-01T00:00:00.000Z'.format(y), 'key': int(y), 'doc_count': c}
+                                            for y, c in sorted(counts.items())]}
+        return result
+
+    def msearch(self, index, body) -> dict:
+        lines = [json.loads(l) for l in body.decode('utf-8').splitlines() if l.strip()]
+        responses = []
+        for header, search in zip(lines[0::2], lines[1::2]):
+            names = self.store.resolve(header.get('index', index))
+            if not names:
+                responses.append({'error': {'type': 'index_not_found_exception', 'reason': 'no such index'}, 'status': 404})
+                continue
+            try:
+                response = self.search(names, search, {})
+                response['status'] = 200
+                responses.append(response)
+            except Exception as e:
+                responses.append({'error': {'type': 'search_phase_execution_exception', 'reason': str(e)}, 'status': 400})
+        return {'took': 0, 'responses': responses}
+
+    def bulk(self, index, body) -> dict:
+        lines = [json.loads(l) for l in body.decode('utf-8').splitlines() if l.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            (action, meta), = lines[i].items()
+            source = lines[i + 1] if action != 'delete' else None
+            i += 1 if action == 'delete' else 2
+            name = meta.get('_index', index)
+            doc_id = str(meta.get('_id') or self.store.next_id('doc'))
+            if not isinstance(source, dict) and action != 'delete':
+                errors = True
+                items.append({action: {'_index': name, '_id': doc_id, 'status': 400, 'error': {'type': 'mapper_parsing_exception', 'reason': 'not an object'}}})
+                continue
+            with self.store.lock:
+                idx = self.store.indices.setdefault(name, {'docs': {}, 'mappings': {}, 'settings': {}})
+                if action == 'delete':
+                    idx['docs'].pop(doc_id, None)
+                else:
+                    idx['docs'][doc_id] = source.get('doc', source) if action == 'update' else source
+            items.append({action: {'_index': name, '_id': doc_id, 'status': 201, 'result': 'created'}})
+        return {'took': 0, 'errors': errors, 'items': items}
+
+
+class FakeAsyncNode(BaseAsyncNode):
+    ''' Same as FakeNode, for AsyncElasticsearch(..., node_class=FakeAsyncNode)
+    '''
+    _CLIENT_META_HTTP_CLIENT = ('fake', '0.1')
+
+    def __init__(self, config) -> None:
+        super().__init__(config)
+        self._node = FakeNode(config)
+
+    async def perform_request(self, method, target, body=None, headers=None, request_timeout=None) -> NodeApiResponse:
+        if FakeNode.store.latency:
+            await asyncio.sleep(FakeNode.store.latency)
+        return self._node.answer(method, target, body, headers)
+
+    async def close(self) -> None:
+        pass
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
@@ -0,0 +1,307 @@
+'''
+Benchmark every route of app.py on synthetic data (see benchmark/data.py) and print the results as JSON:
+p50/p90/p99 latency, throughput, bytes per response and error count per scenario, plus the peak RSS of the process.
+
+By default elastic is replaced by the in-process FakeNode (benchmark/fake_es.py), so this runs anywhere and measures
+the cost of this repo's own code (plus the fake's own, pure Python, query matching, so compare runs with each other
+rather than with production numbers); --latency-ms adds a network hop to every elastic request. With --es-host the
+same scenarios run against a real node, eg a local docker container; the synthetic indices are loaded there first
+(existing indices with the same names are reused unless --recreate is given, which deletes them).
+
+Usage, from the repository root:
+    python -m benchmark.run --scale 20000 --requests 50 --output bench.json
+    python -m benchmark.run --es-host http://localhost:9200 --scale 100000 --recreate
+    python -m benchmark.run --only get_documents,studyfromanyid --concurrency 8
+    python -m benchmark.run --requests 5 --compare-json
+
+--compare-json also encodes every JSON response with flask's own JSON provider and counts the responses whose bytes
+differ from what the app sent (utils.JSONProvider uses orjson when it is installed), and lists the values known to be
+encoded differently.
+'''
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))#the repo modules are imported flat
+
+from benchmark import data
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)#bytes on macOS, KiB on Linux
+
+
+def percentile(values, p) -> float:
+    ''' Nearest-rank percentile of a sorted list
+    '''
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def setup_fake(args) -> dict:
+    ''' Point the sync and async clients at in-process fake nodes and load the synthetic tables into them
+    '''
+    from elasticsearch import AsyncElasticsearch, Elasticsearch
+    from benchmark.fake_es import FakeAsyncNode, FakeNode
+    import async_elastic_functions
+    import elastic_functions
+    import metrics
+
+    sync_node, async_node = FakeNode, FakeAsyncNode
+    if metrics.METRICS_ENABLED:#same per-request instrumentation as production
+        sync_node, async_node = metrics.instrumented(FakeNode), metrics.instrumented(FakeAsyncNode)
+    elastic_functions._es = Elasticsearch('http://fake:9200', node_class=sync_node)
+    elastic_functions._es_pid = os.getpid()
+    async_elastic_functions.get_loop()
+    async_elastic_functions._es = AsyncElasticsearch('http://fake:9200', node_class=async_node)
+
+    FakeNode.store.latency = args.latency_ms / 1000
+    counts = {}
+    for index, docs in data.dataset(args.scale, args.seed).items():
+        docs = list(docs)
+        FakeNode.store.load(index, docs, mappings=data.MAPPINGS[index], id_field=data.ID_FIELDS.get(index))
+        counts[index] = len(docs)
+    return counts
+
+
+def setup_elastic(args) -> dict:
+    ''' Point both clients at a real node and load the synthetic tables, unless they are there already
+    '''
+    import async_elastic_functions
+    import elastic_functions
+
+    elastic_functions.ESKNN_HOST = async_elastic_functions.ESKNN_HOST = args.es_host
+    es = elastic_functions.get_es()
+    esknn = elastic_functions.ESKNN()
+    counts = {}
+    for index, docs in data.dataset(args.scale, args.seed).items():
+        if args.recreate:
+            es.indices.delete(index=index, ignore_unavailable=True)
+        if not es.indices.exists(index=index):
+            es.indices.create(index=index, **data.index_body(index))
+            esknn.ingest(docs, index=index, id_field=data.ID_FIELDS.get(index), pause_refresh=True)
+        es.indices.refresh(index=index)
+        counts[index] = es.count(index=index)['count']
+    return counts
+
+
+def scenarios(args, rng) -> list:
+    ''' One entry per route (some routes with several variants). 'json' is a function, so that every request
+    asks for different IDs, the way real traffic does.
+    '''
+    n_studies = data.study_count(args.scale)
+    reports = lambda k: rng.sample(range(1, args.scale + 1), min(k, args.scale))
+    studies = lambda k: rng.sample(range(1, n_studies + 1), min(k, n_studies))
+    linked = lambda index, k: rng.sample(range(1, data.LINKED_IDS[index][1] + 1), k)
+    query = lambda: 'Title:{} AND Abstract:{}'.format(rng.choice(data.WORDS), rng.choice(data.WORDS))
+    many = args.ids
+
+    def upload():
+        docs = data.reports(args.ingest_docs, rng.randint(0, 10 ** 6))
+        return ''.join(json.dumps(doc) + '\n' for doc in docs)
+
+    return [
+        {'name': 'index', 'method': 'GET', 'path': '/'},
+        {'name': 'healthz', 'method': 'GET', 'path': '/healthz'},
+        {'name': 'readyz', 'method': 'GET', 'path': '/readyz'},
+        {'name': 'metrics', 'method': 'GET', 'path': '/metrics'},
+        {'name': 'get_current_index', 'method': 'GET', 'path': '/api/get_current_index'},
+        {'name': 'cache_stats', 'method': 'GET', 'path': '/api/cache_stats'},
+        {'name': 'get_documents_10', 'path': '/api/get_documents', 'json': lambda: {'input': reports(10)}},
+        {'name': 'get_documents_{}'.format(many), 'path': '/api/get_documents', 'json': lambda: {'input': reports(many)}},
+        {'name': 'get_documents_{}_stream'.format(many), 'path': '/api/get_documents', 'json': lambda: {'input': reports(many), 'stream': True}},
+        {'name': 'get_documents_{}_include'.format(many), 'path': '/api/get_documents',
+         'json': lambda: {'input': reports(many), 'include': ['CRGReportID', 'Title', 'Year']}},
+        {'name': 'get_documents_{}_ris'.format(many), 'path': '/api/get_documents', 'json': lambda: {'input': reports(many), 'return_as': 'ris'}},
+        {'name': 'search_query', 'path': '/api/search_query', 'json': lambda: {'input': query(), 'index': 'tblreport'}},
+        {'name': 'search_query_docvalues', 'path': '/api/search_query', 'json': lambda: {'input': query(), 'index': 'tblreport', 'docvalues': True}},
+        {'name': 'direct_retrieval', 'path': '/api/direct_retrieval', 'json': lambda: {'input': query(), 'index': 'tblreport'}},
+        {'name': 'direct_retrieval_leading_wildcard', 'path': '/api/direct_retrieval',
+         'json': lambda: {'input': 'Authors:*{}'.format(rng.choice(data.SURNAMES)[-3:].lower()), 'index': 'tblreport'}},
+        {'name': 'analyze_query_leading_wildcard', 'path': '/api/analyze_query',
+         'json': lambda: {'input': 'Authors:*{}'.format(rng.choice(data.SURNAMES)[-3:].lower()), 'index': 'tblreport'}},
+        {'name': 'direct_retrieval_stream', 'path': '/api/direct_retrieval', 'json': lambda: {'input': query(), 'index': 'tblreport', 'stream': True}},
+        {'name': 'direct_retrieval_page', 'path': '/api/direct_retrieval', 'json': lambda: {'input': query(), 'index': 'tblreport', 'size': 100}},
+        {'name': 'direct_retrieval_count', 'path': '/api/direct_retrieval', 'json': lambda: {'input': query(), 'index': 'tblreport', 'count': True}},
+        {'name': 'direct_retrieval_facets', 'path': '/api/direct_retrieval',
+         'json': lambda: {'input': query(), 'index': 'tblreport', 'facets': [{'field': 'Year', 'type': 'histogram'}, 'Volume']}},
+        {'name': 'direct_retrieval_csv', 'path': '/api/direct_retrieval',
+         'json': lambda: {'input': query(), 'index': 'tblreport', 'return_as': 'csv', 'include': ['CRGReportID', 'Title', 'Authors', 'Year']}},
+        {'name': 'batch_search_10', 'path': '/api/batch_search',
+         'json': lambda: {'input': [{'input': query(), 'index': 'tblreport', 'size': 100} for _ in range(10)]}},
+        {'name': 'reportsfromstudyid', 'path': '/api/reportsfromstudyid', 'json': lambda: {'input': studies(many // 3)}},
+        {'name': 'studyfromanyid_report', 'path': '/api/studyfromanyid', 'json': lambda: {'table': 'report', 'input': reports(many)}},
+        {'name': 'studyfromanyid_condition', 'path': '/api/studyfromanyid',
+         'json': lambda: {'table': 'condition', 'input': linked('tblstudyhealthcarecondition', 20)}},
+        {'name': 'traverse_condition_report', 'path': '/api/traverse',
+         'json': lambda: {'from': 'condition', 'to': 'report', 'input': linked('tblstudyhealthcarecondition', 20)}},
+        {'name': 'async_reportsfromstudyid', 'path': '/api/async/reportsfromstudyid', 'json': lambda: {'input': studies(many // 3)}},
+        {'name': 'async_studyfromanyid', 'path': '/api/async/studyfromanyid',
+         'json': lambda: {'input': {'condition': linked('tblstudyhealthcarecondition', 10), 'intervention': linked('tblstudyintervention', 10),
+                                    'report': reports(many // 10)}}},
+        {'name': 'ingest_{}'.format(args.ingest_docs), 'path': '/api/ingest?index=tblbench&id_field=CRGReportID',
+         'body': upload, 'content_type': 'application/x-ndjson'},
+        {'name': 'set_current_index', 'path': '/api/set_current_index', 'json': lambda: {'input': 'tblreport'}},#drops cached documents, so last
+    ]
+
+
+JSON_EDGE_CASES = [0.1, 1e16, 1e-7, 1.5e300, 5e-324, -0.0, 2 ** 70, float('nan'), float('inf'), {'b': 'é😀', 'a': None}]
+
+
+def json_differences(app) -> list:
+    ''' The values of JSON_EDGE_CASES that app.json encodes differently from flask's own JSON provider
+    '''
+    from flask.json.provider import DefaultJSONProvider
+    reference = DefaultJSONProvider(app)
+    found = []
+    for value in JSON_EDGE_CASES:
+        ours, theirs = app.json.dumps(value, separators=(',', ':')), reference.dumps(value, separators=(',', ':'))
+        if ours != theirs:
+            found.append({'value': repr(value), 'app': ours, 'flask': theirs})
+    return found
+
+
+def measure(app, scenario, args) -> dict:
+    local = threading.local()
+    reference = None
+    if args.compare_json:
+        from flask.json.provider import DefaultJSONProvider
+        reference = DefaultJSONProvider(app)
+
+    def one(_):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        kwargs = {}
+        if 'json' in scenario:
+            kwargs['json'] = scenario['json']()
+        if 'body' in scenario:
+            kwargs['data'], kwargs['content_type'] = scenario['body'](), scenario['content_type']
+        start = time.perf_counter()
+        response = local.client.open(scenario['path'], method=scenario.get('method', 'POST'), **kwargs)
+        body = response.get_data()
+        response.close()
+        seconds = time.perf_counter() - start
+        ok = response.status_code == 200
+        same = None
+        if response.mimetype == 'application/json':
+            payload = json.loads(body)
+            ok = ok and (not isinstance(payload, dict) or payload.get('status', 200) == 200)
+            if reference is not None:#what flask's own provider would have sent for the same response
+                same = reference.response(payload).get_data() == body
+        return seconds, ok, len(body), same
+
+    for i in range(args.warmup):
+        one(i)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r[0] * 1000 for r in results)
+    result = {
+        'name': scenario['name'],
+        'route': scenario['path'].split('?')[0],
+        'requests': len(results),
+        'errors': sum(1 for r in results if not r[1]),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(latencies[-1], 3),
+        'throughput_rps': round(len(results) / wall, 2),
+        'bytes_per_response': round(sum(r[2] for r in results) / len(results)),
+        'peak_rss_mb': peak_rss_mb(),#running peak of the process, so growth shows which scenario needed the memory
+    }
+    if args.compare_json:
+        result['json_differs'] = sum(1 for r in results if r[3] is False)#responses whose bytes differ from flask's provider
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description='Benchmark the routes of app.py on synthetic data')
+    parser.add_argument('--scale', type=int, default=20000, help='number of reports; studies and links scale with it')
+    parser.add_argument('--ids', type=int, default=1000, help='IDs per request in the large ID-list scenarios')
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight at the same time')
+    parser.add_argument('--ingest-docs', type=int, default=500, help='documents per upload in the ingest scenario')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='delay added to every request to the fake elastic')
+    parser.add_argument('--es-host', help='run against this elastic node instead of the in-process fake')
+    parser.add_argument('--recreate', action='store_true', help='with --es-host: delete and reload the synthetic indices')
+    parser.add_argument('--only', help='comma separated scenario names (or prefixes) to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare-json', action='store_true', help="compare every JSON response with flask's own JSON provider")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    counts = setup_elastic(args) if args.es_host else setup_fake(args)
+    load_seconds = time.perf_counter() - start
+
+    import config
+    from app import app
+    from link_index import link_index
+    config.INGEST_ENABLED = True#the ingest scenario loads into its own tblbench index
+    logging.getLogger().setLevel(logging.WARNING)
+
+    link_index.start()#warm up the in-memory link tables like a worker that has been running for a while
+    deadline = time.time() + 300
+    while link_index.state()['enabled'] and link_index.state()['missing'] and time.time() < deadline:
+        time.sleep(0.1)
+
+    rng = random.Random(args.seed)
+    selected = [s for s in scenarios(args, rng)
+                if not args.only or any(s['name'].startswith(prefix) for prefix in args.only.split(','))]
+    results = []
+    for scenario in selected:
+        results.append(measure(app, scenario, args))
+        print('{name}: p50 {p50_ms}ms p99 {p99_ms}ms {throughput_rps}/s, {errors} errors'.format(**results[-1]), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'backend': args.es_host or 'fake',
+            'scale': args.scale,
+            'ids': args.ids,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'latency_ms': args.latency_ms,
+            'seed': args.seed,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'load_seconds': round(load_seconds, 2),
+        },
+        'dataset': counts,
+        'scenarios': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if args.compare_json:
+        report['json_edge_cases'] = json_differences(app)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main()
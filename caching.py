@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LRUCache():
+    ''' Thread-safe least-recently-used cache. Entries expire ttl seconds after they were stored and the
+    least recently used entries are dropped once there are more than max_entries. Hits and misses are counted.
+    Cached values are shared between callers, so they must not be changed after they are stored.
+    '''
+
+    def __init__(self, max_entries, ttl) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()#key -> (value, time stored)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:#expired
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, match=None) -> int:
+        ''' Drop every entry whose key match(key) is true for, or everything if match is None.
+        Returns the number of entries dropped.
+        '''
+        with self._lock:
+            if match is None:
+                dropped = len(self._data)
+                self._data.clear()
+            else:
+                keys = [k for k in self._data if match(k)]
+                for k in keys:
+                    del self._data[k]
+                dropped = len(keys)
+        return dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class SingleFlight():
+    ''' Runs func once per key at a time: callers asking for a key that is already being computed wait for that
+    computation and get its result (or its exception) instead of starting their own. Nothing is kept afterwards,
+    combine with an LRUCache for that. Results are shared between callers, so they must not be changed.
+    A caller that gives a timeout waits at most that many seconds for someone else's computation, then gets
+    concurrent.futures.TimeoutError; the computation itself runs on.
+    '''
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.shared = 0
+        self._running = {}#key -> Future of the running call
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            future = self._running.get(key)
+            leader = future is None
+            if leader:
+                future = self._running[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result(timeout)
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._running[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared, 'running': len(self._running)}
@@ -1,5 +1,108 @@
 INDEX_NAME = 'tblreport'
 ESKNN_HOST = 'http://localhost:9200'
+ES_CONNECTIONS_PER_NODE=10#size of the HTTP connection pool to each elastic node, per worker process
+ES_HTTP_COMPRESS=False#gzip request bodies and ask elastic for gzipped responses (helps when elastic is on another machine)
+ES_REQUEST_TIMEOUT=30#seconds before a request to elastic times out
+ES_MAX_RETRIES=3#how often a failed request to elastic is retried, on another node if there are several
+ES_RETRY_ON_TIMEOUT=True#also retry requests that timed out
+REQUEST_DEADLINE=60#seconds an API request may spend on elastic before it returns what it has with "partial": true; requests can ask for another 'timeout'. 0 turns deadlines off
+STREAM_DEADLINE=600#the same for streamed responses (stream or return_as); a cut NDJSON stream ends with a {"partial":true} line
+MAX_REQUEST_DEADLINE=600#largest 'timeout' a request can ask for
+DEADLINE_GRACE=1#seconds added to the HTTP timeout of a request to elastic with a deadline, so elastic can still send what it found by its own timeout
+SCROLL_KEEP_ALIVE='1m'#how long elastic keeps a scroll context between two pages; scrolls are cleared as soon as they finish or are cut short
 
 RET_FIELD='CRGReportID'
 RETURN_AS='dict'
+
+ID_CHUNK_SIZE=500#max number of IDs that retrieve_documents sends to elastic in one filter
+ID_LOOKUP_THREADS=4#number of ID chunks that are looked up at the same time
+INDEX_CACHE_TTL=300#seconds to remember whether an index exists and how its fields are mapped
+SEARCH_DOCVALUES=False#True: search_query reads ret_field from doc values rather than _source (keyword/numeric fields only)
+SCAN_SLICES=1#split full-result searches into this many scroll slices read in parallel, 1 = one plain scroll; at most the number of shards is useful
+MAX_SCAN_SLICES=16#largest number of slices a request can ask for
+STREAM_CHUNK_BYTES=65536#streamed (ndjson) responses are flushed to the client in chunks of about this size
+FAST_JSON=True#encode JSON responses with orjson when it is installed (same bytes as the standard library json, except the spelling of float exponents and NaN/Infinity, see utils.JSONProvider)
+LOG_LEVEL='INFO'#DEBUG also logs every request and per-query hit counts
+LOG_JSON=False#True: one JSON object per log line, for log shippers; False: plain text with key=value fields
+LOG_SLOW_REQUESTS=2.0#requests slower than this many seconds are logged as warnings
+METRICS_ENABLED=True#collect request and elastic timings, served in Prometheus text format at /metrics
+LATENCY_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)#upper bounds (seconds) of the latency histograms
+PAGE_SIZE=50#hits per page when a search endpoint is asked for a page but gives no size
+MAX_PAGE_SIZE=10000#largest page size a client may ask for (elastic's default max_result_window)
+PIT_KEEP_ALIVE='1m'#how long a point in time is kept open between two page requests
+
+STUDY_FIELD='CRGStudyID'#study ID field shared by tblstudy and the link tables
+LINK_TABLES={#'table' names accepted by /api/studyfromanyid -> (link table, field to search in it)
+    'report': ('tblstudyreport', 'CRGReportID'),
+    'condition': ('tblstudyhealthcarecondition', 'HealthCareConditionID'),
+    'intervention': ('tblstudyintervention', 'InterventionID'),
+    'outcome': ('tblstudyoutcome', 'OutcomeID'),
+}
+JOIN_DOCUMENTS={#entities of the join graph that have their own index -> (index, ID field), for /api/traverse
+    'study': ('tblstudy', STUDY_FIELD),
+    'report': ('tblreport', 'CRGReportID'),
+}
+JOIN_LINKS=[(index, name, field, 'study', STUDY_FIELD) for name, (index, field) in LINK_TABLES.items()]#edges of the join graph, followed both ways: (link index, entity, its ID field, other entity, its ID field)
+LINK_INDEX_ENABLED=True#keep the link tables in memory so joins need only one elastic round trip
+LINK_INDEX_REFRESH=600#seconds between two reloads of the in-memory link tables
+
+DOC_CACHE_SIZE=50000#number of IDs whose documents are cached by retrieve_documents, 0 turns the cache off
+DOC_CACHE_TTL=600#seconds a cached document lookup stays valid
+DOC_CACHE_MAX_DOCS_PER_ID=100#IDs matching more documents than this (eg big studies) are not cached
+QUERY_CACHE_SIZE=1000#number of ID search results search_query keeps (whole documents are never cached), 0 turns the cache off (identical concurrent searches are still shared)
+QUERY_CACHE_TTL=10#seconds a cached search result stays valid; short, so new documents show up quickly
+QUERY_CACHE_MAX_HITS=10000#results with more hits than this are shared between concurrent requests but not cached
+QUERY_MAX_COST=5000#query strings with a higher estimated cost are rejected (see query_analyzer.py), 0 turns the check off
+QUERY_THROTTLE_COST=100#query strings costing more than this, eg one leading wildcard, run at most QUERY_THROTTLE_SLOTS at a time; 0 turns throttling off
+QUERY_THROTTLE_SLOTS=2#expensive query strings running at the same time per worker process
+QUERY_THROTTLE_WAIT=10#seconds an expensive query waits for a slot before it is turned away
+QUERY_REWRITE=True#rewrite leading wildcards (Authors:*dams) to the reverse subfield and infix ones (Authors:*dam*) to the n-gram subfield, where the index maps them
+QUERY_REVERSE_SUBFIELD='reverse'#subfield indexed with a reverse token filter, eg Authors.reverse
+QUERY_NGRAM_SUBFIELD='ngram'#subfield indexed with an n-gram tokenizer, eg Authors.ngram
+QUERY_NGRAM_MIN=3#min_gram of the n-gram subfields; shorter infix strings stay wildcards
+QUERY_ANALYSIS_CACHE_SIZE=1000#parsed query strings kept, by query text
+BATCH_SEARCH_SIZE=10000#default max hits per query in /api/batch_search
+ASYNC_MAX_CONCURRENCY=16#max elastic requests the async join endpoints have in flight per worker process
+
+INGEST_ENABLED=False#serve /api/ingest, which lets anyone who can reach the API write to any index; keep it off on public deployments
+INGEST_CHUNK_SIZE=500#documents per bulk request in /api/ingest
+INGEST_MAX_CHUNK_SIZE=5000#largest chunk_size a request can ask for
+INGEST_THREADS=4#bulk requests in flight at the same time in /api/ingest, 1 streams them one after the other
+INGEST_MAX_THREADS=8#most threads a request can ask for
+INGEST_MAX_ERRORS=100#max number of failed documents listed in an ingest response
+FACET_SIZE=20#default number of buckets returned per terms facet
+
+RIS_FIELDS={#RIS tag -> field in the report index, used by return_as 'ris'
+    'TI': 'Title',
+    'AU': 'Authors',
+    'PY': 'Year',
+    'JO': 'Journal',
+    'VL': 'Volume',
+    'IS': 'Issue',
+    'SP': 'Pages',
+    'DO': 'DOI',
+    'AB': 'Abstract',
+    'AN': 'CRGReportID',
+}
+PUBMED_FIELDS={#MEDLINE tag -> field in the report index, used by return_as 'pubmed'
+    'PMID': 'PMID',
+    'TI': 'Title',
+    'AU': 'Authors',
+    'AB': 'Abstract',
+    'DP': 'Year',
+    'TA': 'Journal',
+    'VI': 'Volume',
+    'IP': 'Issue',
+    'PG': 'Pages',
+    'AID': 'DOI',
+}
+AUTHOR_SEPARATOR=';'#authors are stored as one string separated by this character
+
+SERVER_BIND='0.0.0.0:9090'#where 'python run.py --production' listens
+SERVER_WORKERS=0#worker processes, 0 = one per CPU core
+SERVER_THREADS=8#threads per worker process, ie requests one worker serves at the same time
+SERVER_WORKER_CONNECTIONS=64#open connections per worker; more wait in the listen backlog
+SERVER_BACKLOG=256#connections waiting to be accepted; when full, new connections are refused instead of queueing forever
+SERVER_TIMEOUT=300#seconds a request may take before its worker is restarted (long exports need a generous value)
+SERVER_GRACEFUL_TIMEOUT=30#seconds running requests get to finish on shutdown or reload
+SERVER_MAX_REQUESTS=0#restart a worker after this many requests (plus some jitter), 0 = never
@@ -1,25 +1,523 @@
 import config
 from elasticsearch import Elasticsearch, helpers
+from elastic_transport import ConnectionTimeout, Urllib3HttpNode
 from typing import Dict
+import base64
+import json
+import os
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import threading
+import time
+import fnmatch
+import logging
 import warnings
 warnings.filterwarnings(action='ignore')
-from elasticsearch_dsl import Search
+
+import metrics
+import query_analyzer
+from caching import LRUCache, SingleFlight
 
 
 INDEX_NAME = config.INDEX_NAME#default index to connect to, unless specified differently per API request. eg 'preprints-biorxiv'
 ESKNN_HOST = config.ESKNN_HOST#where elastic lives, eg 'http://localhost:9200'
+ES_CONNECTIONS_PER_NODE = config.ES_CONNECTIONS_PER_NODE#HTTP connections per elastic node and worker process
+ES_HTTP_COMPRESS = config.ES_HTTP_COMPRESS#gzip requests and responses
+ES_REQUEST_TIMEOUT = config.ES_REQUEST_TIMEOUT#seconds before a request to elastic times out
+ES_MAX_RETRIES = config.ES_MAX_RETRIES#retries of a failed request to elastic
+ES_RETRY_ON_TIMEOUT = config.ES_RETRY_ON_TIMEOUT#also retry requests that timed out
 RET_FIELD = config.RET_FIELD#main field to use as unique ID when query and actual document retrieval are split (like PubMed API), eg.
 RETURN_AS = config.RETURN_AS#Output format, eg 'dict', 'ris' or whatever is implemented (see utils function 'format_output' for current options.
+ID_CHUNK_SIZE = config.ID_CHUNK_SIZE#max number of IDs per lookup request, keeps us well below elastic's max_clause_count
+ID_LOOKUP_THREADS = config.ID_LOOKUP_THREADS#how many ID chunks are searched at the same time
+SEARCH_DOCVALUES = config.SEARCH_DOCVALUES#read ret_field from doc values instead of _source in search_query
+SCAN_SLICES = config.SCAN_SLICES#default number of scroll slices read in parallel by search_query
+MAX_SCAN_SLICES = config.MAX_SCAN_SLICES#upper limit for the slices of one request
+PAGE_SIZE = config.PAGE_SIZE#default number of hits per page for cursor pagination
+MAX_PAGE_SIZE = config.MAX_PAGE_SIZE#largest page a client can ask for
+BATCH_SEARCH_SIZE = config.BATCH_SEARCH_SIZE#default number of hits per query in batch_search
+PIT_KEEP_ALIVE = config.PIT_KEEP_ALIVE#how long a point in time stays open between two page requests
+SCROLL_KEEP_ALIVE = config.SCROLL_KEEP_ALIVE#how long a scroll context stays open between two pages
+DEADLINE_GRACE = config.DEADLINE_GRACE#seconds on top of the time left, for elastic to answer after its own timeout
+DOC_CACHE_SIZE = config.DOC_CACHE_SIZE#max number of IDs whose documents retrieve_documents keeps in memory, 0 turns the cache off
+DOC_CACHE_TTL = config.DOC_CACHE_TTL#seconds a cached ID lookup stays valid
+DOC_CACHE_MAX_DOCS_PER_ID = config.DOC_CACHE_MAX_DOCS_PER_ID#IDs that match more documents than this are not cached
+QUERY_CACHE_SIZE = config.QUERY_CACHE_SIZE#max number of search results search_query keeps in memory, 0 turns the cache off
+QUERY_CACHE_TTL = config.QUERY_CACHE_TTL#seconds a cached search result stays valid
+QUERY_CACHE_MAX_HITS = config.QUERY_CACHE_MAX_HITS#larger results are not cached
+INGEST_CHUNK_SIZE = config.INGEST_CHUNK_SIZE#documents per bulk request when ingesting
+INGEST_MAX_CHUNK_SIZE = config.INGEST_MAX_CHUNK_SIZE#upper limit for the chunk_size of one ingest
+INGEST_THREADS = config.INGEST_THREADS#bulk requests in flight at the same time when ingesting
+INGEST_MAX_THREADS = config.INGEST_MAX_THREADS#upper limit for the threads of one ingest
+INGEST_MAX_ERRORS = config.INGEST_MAX_ERRORS#max number of failed documents reported back by ingest
+FACET_SIZE = config.FACET_SIZE#default number of buckets per terms facet
+INDEX_CACHE_TTL = config.INDEX_CACHE_TTL#seconds that index existence and field mappings are cached for
+SCAN_PAGE_SIZE = 1000#hits per scroll page, and per search of an ID lookup, as in helpers.scan
+
+log = logging.getLogger(__name__)
+
+####################Default setup to conect to main index. The client is only built on first use, so importing
+####################this module never waits for elastic, and every (forked) worker process builds its own.
+_es = None
+_es_pid = None
+_es_lock = threading.Lock()
 
-####################Default setup to conect to main index
-es = Elasticsearch(
-    hosts=[ESKNN_HOST]
+CLIENT_OPTIONS = dict(
+    connections_per_node=ES_CONNECTIONS_PER_NODE,
+    http_compress=ES_HTTP_COMPRESS,
+    request_timeout=ES_REQUEST_TIMEOUT,
+    max_retries=ES_MAX_RETRIES,
+    retry_on_timeout=ES_RETRY_ON_TIMEOUT,
 )
 
-if es.ping():
-    print('elastic_functions.py: Connected to elastic host <{}>'.format(config.ESKNN_HOST))
-else:
-    print('elastic_functions.py: Unable to connect to elastic host <{}>'.format(config.ESKNN_HOST))
+
+def get_es() -> Elasticsearch:
+    ''' The elastic client of this process, built on first use
+    '''
+    global _es, _es_pid
+    if _es_pid != os.getpid():
+        with _es_lock:
+            if _es_pid != os.getpid():
+                node_class = metrics.instrumented(Urllib3HttpNode) if metrics.METRICS_ENABLED else Urllib3HttpNode
+                _es = Elasticsearch(hosts=[ESKNN_HOST], node_class=node_class, **CLIENT_OPTIONS)
+                _es_pid = os.getpid()
+    return _es
+
+
+def _reset_after_fork() -> None:
+    global _es, _es_pid, _es_lock
+    _es, _es_pid = None, None#pooled sockets of the parent must not be shared with the child
+    _es_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def pool_state() -> dict:
+    ''' Nodes of the connection pool and whether elastic answers, for the health endpoints
+    '''
+    client = get_es()
+    pool = client.transport.node_pool
+    nodes = []
+    for node in pool.all():
+        connections = getattr(node, 'pool', None)#urllib3 pool of the default node class
+        nodes.append({
+            'host': node.base_url,
+            'alive': node.config in pool._alive_nodes,
+            'connections': getattr(connections, 'num_connections', None),
+            'idle_connections': connections.pool.qsize() if getattr(connections, 'pool', None) is not None else None,
+            'requests': getattr(connections, 'num_requests', None),
+        })
+    try:
+        reachable = bool(client.options(request_timeout=2, max_retries=0).ping())
+    except Exception:
+        reachable = False
+    return {'reachable': reachable, 'nodes': nodes, 'connections_per_node': ES_CONNECTIONS_PER_NODE}
+
+
+
+class IndexRegistry():
+    ''' Remembers which indices/aliases exist and how their fields are mapped, so that requests do not need an
+    extra round trip to elastic every time they name an index. Entries expire after INDEX_CACHE_TTL seconds.
+    '''
+
+    def __init__(self, ttl=INDEX_CACHE_TTL) -> None:
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._exists = {}#index name -> (bool, time checked)
+        self._field_types = {}#(index name, field) -> (elastic field type, time checked)
+
+    def _get(self, cache, key):
+        with self._lock:
+            entry = cache.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry
+        return None
+
+    def exists(self, name) -> bool:
+        ''' True if the index, alias or wildcard expression matches something in elastic\n
+                    ----------------
+                    Takes -> str\n
+                    Returns -> bool
+                '''
+        entry = self._get(self._exists, name)
+        if entry is None:
+            entry = (bool(get_es().indices.exists(index=name)), time.time())
+            with self._lock:
+                self._exists[name] = entry
+        return entry[0]
+
+    def field_type(self, name, field) -> str:
+        ''' Mapping type of a field (eg 'long', 'keyword' or 'text'). If one of the indices matched by a wildcard
+        maps the field as text, 'text' is returned, because then we need phrase matching.\n
+                    ----------------
+                    Takes -> str, str\n
+                    Returns -> str or None if the field is not mapped
+                '''
+        entry = self._get(self._field_types, (name, field))
+        if entry is None:
+            field_type = None
+            mappings = get_es().indices.get_field_mapping(index=name, fields=field)
+            for index_mapping in dict(mappings).values():
+                for field_mapping in index_mapping.get('mappings', {}).values():
+                    for leaf in field_mapping.get('mapping', {}).values():
+                        if field_type != 'text':
+                            field_type = leaf.get('type')
+            entry = (field_type, time.time())
+            with self._lock:
+                self._field_types[(name, field)] = entry
+        return entry[0]
+
+    def invalidate(self, name=None) -> None:
+        ''' Forget what we know about one index, or about all of them if no name is given
+        '''
+        with self._lock:
+            if name is None:
+                self._exists.clear()
+                self._field_types.clear()
+            else:
+                self._exists.pop(name, None)
+                for key in [k for k in self._field_types if k[0] == name]:
+                    del self._field_types[key]
+
+
+index_registry = IndexRegistry()
+
+doc_cache = LRUCache(DOC_CACHE_SIZE, DOC_CACHE_TTL)#(index, field, id) -> [(hit key, document), ...]
+query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)#(index, query, ret_field, options) -> list of IDs
+query_flight = SingleFlight()#identical searches running at the same time share one scroll
+_query_generation = [0]#bumped by invalidate_documents, so searches that overlap a write are not cached
+metrics.registry.add(metrics.Gauge('doc_cache', 'Entries, hits, misses and evictions of the document cache', labels=('stat',),
+                                   read=lambda: {(k,): v for k, v in doc_cache.stats().items() if k in ('entries', 'hits', 'misses', 'evictions')}))
+metrics.registry.add(metrics.Gauge('query_cache', 'Entries, hits and misses of the search result cache, and searches run or shared',
+                                   labels=('stat',),
+                                   read=lambda: dict([((k,), v) for k, v in query_cache.stats().items() if k in ('entries', 'hits', 'misses', 'evictions')]
+                                                     + [((k,), v) for k, v in query_flight.stats().items()])))
+
+
+def invalidate_documents(index_name) -> int:
+    ''' Drop cached lookups and search results for an index, including those made through wildcards that match it.
+    Returns the number of cache entries dropped.
+    '''
+    match = lambda key: key[0] == index_name or fnmatch.fnmatchcase(index_name, key[0])
+    _query_generation[0] += 1
+    return doc_cache.invalidate(match) + query_cache.invalidate(match)
+
+
+def analyze_query(query, index) -> 'query_analyzer.Analysis':
+    ''' Rewrite the expensive wildcards of a query_string where the mapping of index allows it, and estimate its
+    cost. Raises query_analyzer.QueryTooExpensive (a ValueError) for queries over QUERY_MAX_COST.
+    '''
+    def has_field(field) -> bool:
+        try:
+            return index_registry.field_type(index, field) is not None
+        except Exception:#eg a missing index, which the search itself will report
+            return False
+
+    analysis = query_analyzer.analyze(query, has_field)
+    query_analyzer.check(analysis)
+    if analysis.rewrites:
+        log.debug('Rewrote query', extra={'index': index, 'query': query, 'rewritten': analysis.query})
+    return analysis
+
+
+def _map_chunks(func, chunks, threads):
+    ''' Apply func to every chunk with up to `threads` chunks in flight at the same time.
+    Results are yielded in the order of the chunks, not in the order they finish.
+    '''
+    if threads <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(chunks))) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(func, chunk))
+            if len(pending) >= threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class Deadline():
+    ''' Time budget of one API request, handed down to every elastic call it makes. Searches get the time that is
+    left as their elastic 'timeout' and as their HTTP timeout, scans stop between two pages once it is used up, and
+    whatever is cut short sets partial, so that the endpoint can return what it has with "partial": true.
+    '''
+
+    def __init__(self, seconds, start=None) -> None:
+        self.end = (time.perf_counter() if start is None else start) + seconds
+        self.partial = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.end - time.perf_counter())
+
+    def expired(self) -> bool:
+        ''' True once the time is up. The caller stops there, so the result is marked partial.
+        '''
+        if time.perf_counter() < self.end:
+            return False
+        self.partial = True
+        return True
+
+    def timeout(self) -> str:
+        ''' The time left as an elastic duration, for the 'timeout' of a search body
+        '''
+        return '{}ms'.format(max(1, int(self.remaining() * 1000)))
+
+    def options(self) -> dict:
+        ''' Client options for one request: no retries, which would not fit in the time left anyway
+        '''
+        return {'request_timeout': self.remaining() + DEADLINE_GRACE, 'max_retries': 0}
+
+    def note(self, response) -> None:
+        ''' Mark the result partial if elastic stopped searching some shards at the search timeout
+        '''
+        if response.get('timed_out'):
+            self.partial = True
+
+
+def _client(deadline=None) -> Elasticsearch:
+    return get_es() if deadline is None else get_es().options(**deadline.options())
+
+
+def _scan(index, body, deadline=None):
+    ''' helpers.scan without its last round trip: the scan ends at the first page with fewer than SCAN_PAGE_SIZE
+    hits, or once it has all hits that elastic counted exactly, instead of asking for an empty page. With a Deadline, the search and every scroll request get the time that
+    is left as their timeout, and once it is used up the scan ends with the hits it has and sets deadline.partial.
+    Without one, shards that fail raise helpers.ScanError as in helpers.scan.
+    The scroll context is cleared when the scan ends, is closed early or runs out of time.
+    '''
+    if deadline is not None and deadline.expired():
+        return
+
+    scroll_id = None
+    seen = 0
+    try:
+        search_body = dict(body, sort='_doc')
+        if deadline is not None:
+            search_body['timeout'] = deadline.timeout()
+        response = _client(deadline).search(index=index, body=search_body, scroll=SCROLL_KEEP_ALIVE, size=SCAN_PAGE_SIZE)
+        total = response['hits'].get('total') or {}
+        while True:
+            scroll_id = response.get('_scroll_id')
+            shards = response.get('_shards', {})
+            if shards.get('successful', 0) + shards.get('skipped', 0) < shards.get('total', 0):
+                if deadline is None:
+                    raise helpers.ScanError(scroll_id, 'Scroll request has failed on {} shards out of {}.'.format(
+                        shards['total'] - shards.get('successful', 0) - shards.get('skipped', 0), shards['total']))
+                deadline.partial = True
+            if deadline is not None:
+                deadline.note(response)
+            hits = response['hits']['hits']
+            seen += len(hits)
+            yield from hits
+            if len(hits) < SCAN_PAGE_SIZE or (total.get('relation') == 'eq' and seen >= total['value']):
+                return
+            if not scroll_id or (deadline is not None and deadline.expired()):
+                return
+            response = _client(deadline).scroll(scroll_id=scroll_id, scroll=SCROLL_KEEP_ALIVE)
+    except ConnectionTimeout:
+        if deadline is None:
+            raise
+        deadline.partial = True
+    finally:
+        if scroll_id:
+            get_es().options(ignore_status=404).clear_scroll(scroll_id=scroll_id)
+
+
+def _lookup_hits(index, body, deadline=None) -> list:
+    ''' All hits of a lookup that usually matches few documents, eg one chunk of IDs: a single search for up to
+    SCAN_PAGE_SIZE hits, and a _scan only if that search reports more matches than it returned.
+    '''
+    if deadline is not None and deadline.expired():
+        return []
+    search_body = dict(body, track_total_hits=True)
+    if deadline is not None:
+        search_body['timeout'] = deadline.timeout()
+    try:
+        response = _client(deadline).search(index=index, body=search_body, size=SCAN_PAGE_SIZE)
+    except ConnectionTimeout:
+        if deadline is None:
+            raise
+        deadline.partial = True
+        return []
+    if deadline is not None:
+        deadline.note(response)
+    hits = response['hits']['hits']
+    if response['hits']['total']['value'] <= len(hits):
+        return hits
+    return list(_scan(index, body, deadline))#the rare chunk that matches more than one page, eg a few very large studies
+
+
+def _sliced_scan(index, body, slices, deadline=None):
+    ''' _scan split into `slices` scroll slices that are read at the same time, one thread each, all with the same
+    deadline. Hits come in no particular order. Every slice thread hands over whole pages and at most two pages per slice wait to be
+    consumed, so a slow consumer holds the scrolls back instead of filling memory. Closing the generator stops the
+    threads, and each clears its scroll context.
+    '''
+    if slices <= 1:
+        yield from _scan(index, body, deadline)
+        return
+
+    pages = queue.Queue(maxsize=2 * slices)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scroll(i):
+        scan = _scan(index, dict(body, slice={'id': i, 'max': slices}), deadline)
+        page = []
+        try:
+            for hit in scan:
+                page.append(hit)
+                if len(page) >= SCAN_PAGE_SIZE:
+                    if not put(page):
+                        return
+                    page = []
+            if not page or put(page):
+                put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            scan.close()#clears the scroll, also when the consumer went away early
+
+    threads = [threading.Thread(target=scroll, args=(i,), name='scan-slice-{}'.format(i), daemon=True) for i in range(slices)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = slices
+        while running:
+            item = pages.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def source_filter(include=None, exclude=None, keep=None):
+    ''' Elastic _source filter from lists of field names (wildcards allowed) to include and/or exclude.
+    keep: a field that has to stay in the documents whatever include and exclude say, eg the field IDs are matched on.
+    Returns None if whole documents are wanted.
+    '''
+    include, exclude = list(include or []), list(exclude or [])
+    if keep and keep != '_id':
+        if include and not any(fnmatch.fnmatchcase(keep, p) for p in include):
+            include.append(keep)
+        exclude = [p for p in exclude if not fnmatch.fnmatchcase(keep, p)]
+    source = {}
+    if include:
+        source['includes'] = include
+    if exclude:
+        source['excludes'] = exclude
+    return source or None
+
+
+def _is_wanted(field, include=None, exclude=None) -> bool:
+    ''' True if field survives the include/exclude lists
+    '''
+    return (not include or any(fnmatch.fnmatchcase(field, p) for p in include)) and \
+        not any(fnmatch.fnmatchcase(field, p) for p in exclude or [])
+
+
+def _source_key(source):
+    if not source:
+        return None
+    return (tuple(source.get('includes', [])), tuple(source.get('excludes', [])))
+
+
+def _chunk_query(values, ret_field, field_type, source=None) -> dict:
+    ''' Non-scoring query for all documents whose ret_field is one of values, returning only the fields in source
+    '''
+    if ret_field == '_id':
+        match = {'ids': {'values': values}}
+    elif field_type == 'text':#analysed fields (eg titles) can not be matched with terms, match the whole phrase instead
+        match = {'bool': {'should': [{'match_phrase': {ret_field: value}} for value in values], 'minimum_should_match': 1}}
+    else:
+        match = {'terms': {ret_field: values}}
+    query = {'query': {'bool': {'filter': [match]}}}
+    if source:
+        query['_source'] = source
+    return query
+
+
+def _cached_chunk(index, chunk, ret_field, field_type, source=None) -> tuple:
+    ''' Split a chunk of values into the ones found in doc_cache ({value: [(hit key, document), ...]})
+    and the list of values that still have to be looked up in elastic
+    '''
+    found = {}
+    if field_type != 'text':#phrase matches can not be traced back to one value, so they are not cached
+        for value in chunk:
+            docs = doc_cache.get((index, ret_field, value, _source_key(source)))
+            if docs is not None:
+                found[value] = docs
+    return found, [value for value in chunk if value not in found]
+
+
+def _merge_chunk(index, chunk, ret_field, field_type, found, missing, hits, source=None, deadline=None) -> list:
+    ''' Group the raw elastic hits for the missing values by the value they matched, cache them, and return the
+    documents of the whole chunk in the order of chunk. Hits that can not be traced back to a value (eg phrase
+    matches on text fields) go last. Nothing is cached once the deadline has cut a lookup short, and values without
+    documents are never cached: other worker processes do not see invalidate_documents, and would keep answering
+    "not found" for newly ingested IDs until the entry expired.
+    '''
+    fetched = {value: [] for value in missing}
+    unmatched = []
+    for hit in hits:
+        doc = hit.get('_source', {})
+        values = [hit['_id']] if ret_field == '_id' else doc.get(ret_field)
+        values = values if isinstance(values, list) else [values]
+        matched = [str(v).strip() for v in values if str(v).strip() in fetched]
+        for value in matched:
+            fetched[value].append(((hit['_index'], hit['_id']), doc))
+        if not matched:
+            unmatched.append(((hit['_index'], hit['_id']), doc))
+
+    complete = deadline is None or not deadline.partial
+    for value, docs in fetched.items():
+        docs.sort(key=lambda d: d[0][1])
+        found[value] = docs
+        if complete and docs and field_type != 'text' and len(docs) <= DOC_CACHE_MAX_DOCS_PER_ID:
+            doc_cache.set((index, ret_field, value, _source_key(source)), docs)
+
+    dat, seen = [], set()
+    for value in chunk:
+        for key, doc in found[value]:
+            if key not in seen:#a document with several values in ret_field can match more than one of them
+                seen.add(key)
+                dat.append(doc)
+    dat.extend(doc for key, doc in sorted(unmatched, key=lambda d: d[0][1]))
+    return dat
+
+
+def _encode_cursor(state) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        assert {'pit', 'index', 'after', 'query', 'ret_field', 'return_docs', 'size', 'source'} <= set(state)
+        assert isinstance(state['size'], int) and 1 <= state['size'] <= MAX_PAGE_SIZE
+    except Exception:
+        raise ValueError('The cursor is not valid, send the cursor exactly as it was returned by the previous page')
+    return state
 
 
 class ESKNN():
@@ -27,8 +525,7 @@ class ESKNN():
     '''
 
     def __init__(self) -> None:
-        self.current_index_name=INDEX_NAME
-        self.search_context = Search(using=es, index=self.current_index_name)
+        self.current_index_name=INDEX_NAME#default index, used when a call does not name one
 
         pass
 
@@ -38,7 +535,7 @@ class ESKNN():
                     Takes -> None\n
                     Returns -> str
                 '''
-        print('elastic_functions.py: Using elastic index {}'.format(self.current_index_name))
+        log.debug('Using elastic index %s', self.current_index_name)
         return self.current_index_name
 
     def set_index_name(self, new_name)-> str:
@@ -50,13 +547,11 @@ class ESKNN():
                     Returns -> None
                 '''
         self.current_index_name = new_name
-        if es.indices.exists(index=new_name):
-            print('elastic_functions.py: New index {} existed and was selected'.format(new_name))
+        invalidate_documents(new_name)#the index may have been rebuilt since we last looked
+        if index_registry.exists(new_name):
+            log.info('New index %s existed and was selected', new_name)
         else:
-            print('elastic_functions.py: WARNING:New index {} did not exist, '
-                  'ignore this if you are using a wildcard to search multiple indices'.format(new_name))
-        self.search_context = Search(using=es, index=self.current_index_name)#chnge the search context for search queries
-
+            log.warning('New index %s did not exist, ignore this if you are using a wildcard to search multiple indices', new_name)
 
         return self.current_index_name
 
@@ -68,65 +563,351 @@ class ESKNN():
         '''
         body = {}
 
-        if es.indices.exists(index=INDEX_NAME):
-            print("elastic_functions.py: Index {} exists".format(INDEX_NAME))
+        if get_es().indices.exists(index=INDEX_NAME):
+            log.info('Index %s exists', INDEX_NAME)
             return 0
 
         try:
-            result = es.indices.create(
+            result = get_es().indices.create(
                 index=INDEX_NAME,
                 body=body,
                 ignore=400
             )
             if 'error' in result:
-                print("elastic_functions.py: Index {} creation error".format(INDEX_NAME))
+                log.error('Index %s creation error', INDEX_NAME, extra={'error': result['error']})
                 return 2
             else:
-                print("elastic_functions.py: Index {} created".format(INDEX_NAME))
+                log.info('Index %s created', INDEX_NAME)
+                index_registry.invalidate(INDEX_NAME)
+                invalidate_documents(INDEX_NAME)
                 return 1
         except:
             return 0
 
-    def search_query(self, query,ret_field=RET_FIELD, return_docs=False) -> Dict:
+    def iter_query(self, query,ret_field=RET_FIELD, return_docs=False, index=None, docvalues=SEARCH_DOCVALUES,
+                   include=None, exclude=None, slices=SCAN_SLICES, deadline=None):
+        ''' Generator behind search_query: yields the hits one at a time straight from the scroll, so callers
+        can stream them without holding the whole result set in memory. The query is analysed right away, so a
+        rejected query raises query_analyzer.QueryTooExpensive here and not in the middle of a stream.
+        include/exclude: with return_docs, only return these fields of the documents (lists of field names, wildcards allowed)
+        slices: read the scroll as this many slices in parallel (at most MAX_SCAN_SLICES); hits then come in no fixed order
+        deadline: Deadline of the request; the scroll stops when it runs out and deadline.partial is set
+            --------------
+        '''
+        slices = max(1, min(int(slices or 1), MAX_SCAN_SLICES))
+
+        index = index or self.current_index_name
+        analysis = analyze_query(query, index)
+
+        #raw hit dicts from the low-level client, no elasticsearch_dsl Response/Hit objects in between
+        body = {'query': {'query_string': {'query': analysis.query}}}
+
+        if return_docs:
+            source = source_filter(include, exclude)
+            if source:
+                body['_source'] = source
+            value = lambda hit: hit.get('_source', {})
+        elif docvalues:
+            body['_source'] = False
+            body['docvalue_fields'] = [ret_field]
+            value = lambda hit: (hit.get('fields', {}).get(ret_field) or ['error:field does not exist?!'])[0]
+        else:
+            body['_source'] = [ret_field]
+            value = lambda hit: hit.get('_source', {}).get(ret_field,'error:field does not exist?!')
+
+        hits = self._scan_hits(index, body, slices, value, analysis.cost, deadline)
+        next(hits)#waits for a throttle slot now, so a busy server also answers 400 before a stream starts
+        return hits
+
+    def _scan_hits(self, index, body, slices, value, cost, deadline):
+        ''' Generator over the values of the hits, holding a throttle slot until it is exhausted or closed. It first
+        yields None once the slot is taken; a generator that is dropped after that is closed and frees its slot.
+        '''
+        with query_analyzer.throttle(cost):
+            yield None
+            with metrics.hop('search', index) as h:
+                for hit in _sliced_scan(index, body, slices, deadline):
+                    h.hits += 1
+                    yield value(hit)
+
+    def search_query(self, query,ret_field=RET_FIELD, return_docs=False, index=None, docvalues=SEARCH_DOCVALUES,
+                     include=None, exclude=None, slices=SCAN_SLICES, deadline=None) -> Dict:
         ''' Search a index using a query_string and return only one field, most likely id field\n
+        index: index to search, defaults to the current index name
+        docvalues: read ret_field from doc values instead of _source. Only works for fields that have doc values,
+        eg keyword, numeric or date fields.
+        include/exclude: with return_docs, only return these fields of the documents (lists of field names, wildcards allowed)
+        slices: read the result as this many scroll slices in parallel, for very large results
+        deadline: Deadline of the request; when it runs out the hits so far are returned and deadline.partial is set
+
+        The query is only sent once, as a scroll. Unless whole documents are wanted, elastic is asked to send
+        back nothing but ret_field. Expensive wildcards are rewritten or the query rejected first, see query_analyzer.py.
+        Identical searches that arrive while one is running wait for it (at most until their own deadline) and share
+        its result, and ID results of up to QUERY_CACHE_MAX_HITS hits are kept for QUERY_CACHE_TTL seconds; whole
+        documents (return_docs) are only shared, never cached. The returned list may be shared with other callers,
+        so it must not be changed. Partial results are shared but not cached.
             --------------
         '''
+        index = index or self.current_index_name
+        key = (index, query, ret_field, bool(return_docs), bool(docvalues) and not return_docs,
+               _source_key(source_filter(include, exclude)) if return_docs else None)
+
+        dat = query_cache.get(key)
+        if dat is None:
+            try:
+                dat, partial = query_flight.do(key, lambda: self._search_all(key, query, ret_field, return_docs, index, docvalues,
+                                                                             include, exclude, slices, deadline),
+                                               timeout=None if deadline is None else deadline.remaining())
+            except FutureTimeout:#the identical search this request waited for outlived its deadline
+                dat, partial = [], True
+            if partial and deadline is not None:#cut short by the deadline of whichever request ran the search
+                deadline.partial = True
 
-        search = self.search_context.query('query_string',query=query)
-        response = search.execute()
+        log.debug('Found %d search results', len(dat), extra={'index': index, 'hits': len(dat)})
 
-        if response.success():  # this just returns a true/false value. So if the success is true, we show the results :)
-            if return_docs:
-                dat = [d.to_dict() for d in search.scan()]
+        return dat
+
+    def _search_all(self, key, query, ret_field, return_docs, index, docvalues, include, exclude, slices, deadline) -> tuple:
+        generation = _query_generation[0]
+        own = None if deadline is None else Deadline(deadline.remaining())#partial of this search only, not of the whole request
+        dat = list(self.iter_query(query, ret_field=ret_field, return_docs=return_docs, index=index, docvalues=docvalues,
+                                   include=include, exclude=exclude, slices=slices, deadline=own))
+        partial = own is not None and own.partial
+        if not partial and not return_docs and len(dat) <= QUERY_CACHE_MAX_HITS and generation == _query_generation[0]:#no ingest while the scroll ran
+            query_cache.set(key, dat)
+        return dat, partial
+
+    def search_page(self, query, ret_field=RET_FIELD, return_docs=False, index=None, size=PAGE_SIZE, cursor=None,
+                    include=None, exclude=None, deadline=None) -> tuple:
+        ''' Get one page of hits for a query_string, for clients that do not want everything at once.\n
+        Without a cursor a point in time is opened on the index and the first page is returned. The returned cursor
+        is an opaque string that holds the point in time, its index, the query and the position of the last hit; passing it back
+        (query and index can then be left out) returns the next page from the same snapshot of the index.
+        The cursor is None after the last page, at which point the point in time is closed. With a deadline, shards
+        that did not finish in time are left out of the page and deadline.partial is set; such a page may be short,
+        but still comes with a cursor.
+            --------------
+            Takes -> query str or None if a cursor is given, ret_field, return_docs, index, size, cursor, include, exclude\n
+            Returns -> (list of hits, cursor str or None)
+        '''
+        if cursor:
+            state = _decode_cursor(cursor)
+        elif not query:
+            raise ValueError('Your request did not include a search query or a cursor from a previous page')
+        else:
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = 0
+            if not 1 <= size <= MAX_PAGE_SIZE:#checked before a point in time is opened, which nothing would close
+                raise ValueError('The page size must be a whole number from 1 to {}'.format(MAX_PAGE_SIZE))
+            index = index or self.current_index_name
+            analyze_query(query, index)#rejects the query before a point in time is opened
+            pit = _client(deadline).open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+            state = {'pit': pit['id'], 'index': index, 'after': None, 'query': query, 'ret_field': ret_field, 'return_docs': return_docs, 'size': size,
+                     'source': source_filter(include, exclude)}
+        #every page is analysed again, against the mapping of the index the point in time was opened on:
+        #a cursor is only base64, so a client could have put any query into it
+        analysis = analyze_query(state['query'], state['index'])
+
+        body = {
+            'query': {'query_string': {'query': analysis.query}},
+            'size': state['size'],
+            'pit': {'id': state['pit'], 'keep_alive': PIT_KEEP_ALIVE},
+            'sort': ['_shard_doc'],#cheapest stable order, the tiebreaker elastic uses for point in time searches anyway
+            'track_total_hits': False,
+        }
+        if deadline is not None:
+            body['timeout'] = deadline.timeout()
+        if not state['return_docs']:
+            body['_source'] = [state['ret_field']]
+        elif state['source']:
+            body['_source'] = state['source']
+        if state['after'] is not None:
+            body['search_after'] = state['after']
+
+        with query_analyzer.throttle(analysis.cost), metrics.hop('search_page', state['index']) as h:
+            response = _client(deadline).search(body=body)
+            hits = response['hits']['hits']
+            h.hits = len(hits)
+        if deadline is not None:
+            deadline.note(response)
+        if state['return_docs']:
+            dat = [hit['_source'] for hit in hits]
+        else:
+            dat = [hit.get('_source', {}).get(state['ret_field'], 'error:field does not exist?!') for hit in hits]
+
+        state['pit'] = response.get('pit_id', state['pit'])#elastic may hand out a new id for the same point in time
+        if len(hits) < state['size'] and not response.get('timed_out'):#a page cut short by the timeout is not the last one
+            get_es().close_point_in_time(body={'id': state['pit']})
+            return dat, None
+
+        if hits:
+            state['after'] = hits[-1]['sort']
+        return dat, _encode_cursor(state)
+
+    def count_query(self, query, index=None, facets=None, deadline=None) -> dict:
+        ''' Count the hits of a query_string and optionally aggregate them, without retrieving a single hit.\n
+        facets: list of facet specs (or a single field name), each a field name (terms facet) or a dict with keys
+            'field', 'type' ('terms', 'histogram' for numbers like a year, or 'date_histogram' for dates),
+            'size' (terms only, default FACET_SIZE), 'interval' (default 1 for histogram, 'year' for date_histogram)
+            and 'name' (defaults to the field name)
+        deadline: Deadline of the request; shards that did not finish in time are left out and deadline.partial is set
+            --------------
+            Returns -> {'total': int, 'facets': {name: [{'key': ..., 'count': int}, ...]}}
+        '''
+        if isinstance(facets, str):
+            facets = [facets]
+        if facets is not None and not isinstance(facets, list):
+            raise ValueError('facets must be a list, eg ["Year", {"field": "Year", "type": "histogram"}]')
+        aggs = {}
+        for facet in facets or []:
+            if isinstance(facet, str):
+                facet = {'field': facet}
+            if not isinstance(facet, dict) or not facet.get('field'):
+                raise ValueError('Each facet needs a field, eg {"field": "Year", "type": "histogram"}')
+            kind = facet.get('type', 'terms')
+            if kind == 'terms':
+                agg = {'terms': {'field': facet['field'], 'size': int(facet.get('size', FACET_SIZE))}}
+            elif kind == 'histogram':
+                agg = {'histogram': {'field': facet['field'], 'interval': facet.get('interval', 1), 'min_doc_count': 1}}
+            elif kind == 'date_histogram':
+                agg = {'date_histogram': {'field': facet['field'], 'calendar_interval': facet.get('interval', 'year'), 'min_doc_count': 1}}
             else:
-                dat = [d.to_dict().get(ret_field,'error:field does not exist?!') for d in search.scan()]
+                raise ValueError('Unknown facet type {}, use terms, histogram or date_histogram'.format(kind))
+            aggs[facet.get('name', facet['field'])] = agg
 
-        print('Found {} search results!'.format(len(dat)))
+        analysis = analyze_query(query, index or self.current_index_name)
+        body = {'query': {'query_string': {'query': analysis.query}}, 'size': 0, 'track_total_hits': True}
+        if aggs:
+            body['aggs'] = aggs
+        if deadline is not None:
+            body['timeout'] = deadline.timeout()
+        with query_analyzer.throttle(analysis.cost), metrics.hop('count', index or self.current_index_name):
+            response = _client(deadline).search(index=index or self.current_index_name, body=body)
+        if deadline is not None:
+            deadline.note(response)
 
-        return dat
+        result = {'total': response['hits']['total']['value'], 'facets': {}}
+        for name, agg in dict(response.get('aggregations') or {}).items():
+            result['facets'][name] = [
+                {'key': bucket.get('key_as_string', bucket['key']), 'count': bucket['doc_count']} for bucket in agg['buckets']
+            ]
+        return result
 
-    def retrieve_documents(self, id_list, ret_field, return_docs=False) -> list:
-        ''' Get a list of values and also potentially a field to search on. Then retrieve all these values. \n
-        id_list: list of anything, eg [234,456,459]
-        ret_field: string specifying which field to be filtered
+    def batch_search(self, specs, deadline=None) -> list:
+        ''' Run several query_string searches in one _msearch round trip.\n
+        specs: list of dicts with keys 'input' (the query), and optional 'index', 'ret_field', 'size' and 'return_docs'
+        Returns one result per spec, in the same order: {"status": 200, "total": N, "response": [...]} or, if that
+        query failed, {"status": 400, "response": "error message"}. One failing query does not fail the others.
+        The queries run at the same time, so their costs add up: queries that would take the total over QUERY_MAX_COST
+        are not run, and the msearch is throttled by the total (see query_analyzer.py).
+        With a deadline, results of queries that did not finish on every shard in time get "partial": true.
             --------------
         '''
+        results = [None] * len(specs)
+        lines, sent, cost = [], [], 0
+        for i, spec in enumerate(specs):
+            if not isinstance(spec, dict) or not spec.get('input'):
+                results[i] = {"status": 400, "response": "Query number {} has no 'input' search query".format(i)}
+                continue
+            try:
+                size = int(spec.get('size', BATCH_SEARCH_SIZE))
+            except (TypeError, ValueError):
+                size = -1
+            if size < 0:
+                results[i] = {"status": 400, "response": "The size of query number {} must be a whole number of 0 or more".format(i)}
+                continue
+            try:
+                analysis = analyze_query(spec['input'], spec.get('index') or self.current_index_name)
+            except query_analyzer.QueryTooExpensive as e:
+                results[i] = {"status": 400, "response": str(e)}
+                continue
+            if query_analyzer.QUERY_MAX_COST and cost + analysis.cost > query_analyzer.QUERY_MAX_COST:#they all run at the same time
+                metrics.QUERY_ANALYSIS.inc(outcome='rejected')
+                results[i] = {"status": 400, "response": "Query number {} was not run: with the queries before it the batch would cost more "
+                                                         "than {}, send it in another batch".format(i, query_analyzer.QUERY_MAX_COST)}
+                continue
+            cost += analysis.cost
+            body = {
+                'query': {'query_string': {'query': analysis.query}},
+                'size': min(size, MAX_PAGE_SIZE),
+                'track_total_hits': True,
+            }
+            if deadline is not None:
+                body['timeout'] = deadline.timeout()
+            if not spec.get('return_docs', False):
+                body['_source'] = [spec.get('ret_field') or RET_FIELD]
+            lines.extend([{'index': spec.get('index') or self.current_index_name}, body])
+            sent.append(i)
 
+        if lines:
+            with query_analyzer.throttle(cost), metrics.hop('batch_search') as h:#one slot for the whole msearch, by its total cost
+                responses = _client(deadline).msearch(body=lines)['responses']
+                h.hits = sum(len(r.get('hits', {}).get('hits', [])) for r in responses)
+            for i, response in zip(sent, responses):
+                if 'error' in response:
+                    error = response['error']
+                    results[i] = {"status": response.get('status', 400), "response": error.get('reason', str(error)) if isinstance(error, dict) else str(error)}
+                    continue
+                hits = response['hits']['hits']
+                if specs[i].get('return_docs', False):
+                    dat = [hit['_source'] for hit in hits]
+                else:
+                    ret_field = specs[i].get('ret_field') or RET_FIELD
+                    dat = [hit.get('_source', {}).get(ret_field, 'error:field does not exist?!') for hit in hits]
+                results[i] = {"status": 200, "total": response['hits']['total']['value'], "response": dat}
+                if deadline is not None and response.get('timed_out'):
+                    deadline.partial = True
+                    results[i]['partial'] = True
 
+        return results
 
-        id_list= list(set(id_list))#make sure IDs are unique
-        id_list=["{}:\"{}\"".format(ret_field, str(i).strip()) for i in id_list]#for each ID add field to search in (ie OpenAlex ID field) and chaiin up the query
-        query=" OR ".join(id_list)#finish query
+    def _lookup_chunk(self, index, chunk, ret_field, field_type, source=None, deadline=None) -> list:
+        ''' Retrieve all documents whose ret_field matches one of the values in chunk, in the order of chunk.
+        Runs as a filter, so elastic does not score anything. Values found in doc_cache are not sent to elastic.
+            --------------
+        '''
+        found, missing = _cached_chunk(index, chunk, ret_field, field_type, source)
+        metrics.LOOKUP_CHUNKS.inc(index=index, source='elastic' if missing else 'cache')
+        hits = _lookup_hits(index, _chunk_query(missing, ret_field, field_type, source), deadline) if missing else []
+        return _merge_chunk(index, chunk, ret_field, field_type, found, missing, hits, source, deadline)
 
-        print(query)
+    def iter_documents(self, id_list, ret_field, index=None, include=None, exclude=None, deadline=None):
+        ''' Generator behind retrieve_documents: yields documents chunk by chunk, in the order of id_list, while
+        the next chunks are still being looked up. At most ID_LOOKUP_THREADS chunks are held in memory.
+        Chunks that are only reached after the deadline are not looked up in elastic.
+            --------------
+        '''
 
-        search = self.search_context.query('query_string', query=query)
-        response = search.execute()
+        id_list = list(dict.fromkeys(str(i).strip() for i in id_list))#make sure IDs are unique, but keep their order
+        chunks = [id_list[i:i + ID_CHUNK_SIZE] for i in range(0, len(id_list), ID_CHUNK_SIZE)]
+        index = index or self.current_index_name
+        field_type = None if ret_field == '_id' else index_registry.field_type(index, ret_field)
 
-        if response.success():  # this just returns a true/false value. So if the success is true, we show the results :)
-            dat = [d.to_dict() for d in search.scan()]
+        source = source_filter(include, exclude, keep=ret_field)#ret_field is needed to put the documents in order
+        strip = source is not None and ret_field != '_id' and not _is_wanted(ret_field, include, exclude)
 
-        return dat
+        with metrics.hop('lookup', index) as h:
+            for docs in _map_chunks(lambda chunk: self._lookup_chunk(index, chunk, ret_field, field_type, source, deadline), chunks, ID_LOOKUP_THREADS):
+                h.hits += len(docs)
+                for doc in docs:
+                    yield {k: v for k, v in doc.items() if k != ret_field} if strip else doc
+
+    def retrieve_documents(self, id_list, ret_field, return_docs=False, index=None, include=None, exclude=None, deadline=None) -> list:
+        ''' Get a list of values and also potentially a field to search on. Then retrieve all these values. \n
+        id_list: list of anything, eg [234,456,459]
+        ret_field: string specifying which field to be filtered
+        index: index to search, defaults to the current index name
+        include/exclude: only return these fields of the documents (lists of field names, wildcards allowed)
+        deadline: Deadline of the request; documents not found in time are left out and deadline.partial is set
+
+        The values are sent as exact-match filters in chunks of ID_CHUNK_SIZE and up to ID_LOOKUP_THREADS chunks
+        are searched at the same time. Documents are returned in the order of id_list.
+            --------------
+        '''
+
+        return list(self.iter_documents(id_list, ret_field, index=index, include=include, exclude=exclude, deadline=deadline))
 
 
 
@@ -136,7 +917,7 @@ class ESKNN():
     #         Takes -> fvecs\n
     #         Returns -> dict from es
     #     '''
-    #     result = es.search(
+    #     result = get_es().search(
     #         request_timeout=30,
     #         index=INDEX_NAME,
     #         body={
@@ -166,9 +947,81 @@ class ESKNN():
         ]
 
         result = helpers.bulk(
-            es,
+            get_es(),
             rows,
             request_timeout=30
         )
+        invalidate_documents(INDEX_NAME)
+
+        return result
+
+    def ingest(self, documents, index=None, chunk_size=INGEST_CHUNK_SIZE, threads=INGEST_THREADS, id_field=None,
+               pause_refresh=False) -> dict:
+        ''' Bulk-load documents into an index. The documents are consumed lazily, so a generator over an upload
+        is never held in memory as a whole.\n
+        documents: iterable of dicts
+        index: index to write to, defaults to INDEX_NAME
+        chunk_size: documents per bulk request, at most INGEST_MAX_CHUNK_SIZE
+        threads: bulk requests in flight at the same time (1 = streaming_bulk, more = parallel_bulk), at most INGEST_MAX_THREADS
+        id_field: optional field whose value is used as document _id, so that re-loading an export overwrites documents
+        pause_refresh: switch off the index refresh while loading and refresh once at the end
+            -----------------------------
+            Returns -> dict with counts of indexed and failed documents, the first INGEST_MAX_ERRORS errors
+            (numbered by position in documents, starting at 1) and throughput
+        '''
+        index = index or INDEX_NAME
+        chunk_size = max(1, min(int(chunk_size or 1), INGEST_MAX_CHUNK_SIZE))
+        threads = max(1, min(int(threads or 1), INGEST_MAX_THREADS))
+
+        def actions():
+            for doc in documents:
+                action = {'_index': index, '_source': doc}
+                if id_field and doc.get(id_field) is not None:
+                    action['_id'] = doc[id_field]
+                yield action
+
+        old_refresh = None
+        pause_refresh = pause_refresh and get_es().indices.exists(index=index)#a new index is created by the first bulk request
+        if pause_refresh:
+            settings = get_es().indices.get_settings(index=index, name='index.refresh_interval')
+            for index_settings in dict(settings).values():
+                old_refresh = index_settings.get('settings', {}).get('index', {}).get('refresh_interval')
+            get_es().indices.put_settings(index=index, body={'index': {'refresh_interval': '-1'}})
+
+        start = time.time()
+        indexed, failed, errors = 0, 0, []
+        try:
+            if threads > 1:
+                results = helpers.parallel_bulk(get_es(), actions(), thread_count=threads, chunk_size=chunk_size,
+                                                raise_on_error=False, raise_on_exception=False)
+            else:
+                results = helpers.streaming_bulk(get_es(), actions(), chunk_size=chunk_size,
+                                                 raise_on_error=False, raise_on_exception=False)
+            for position, (ok, item) in enumerate(results, start=1):#both helpers report results in input order
+                if ok:
+                    indexed += 1
+                    continue
+                failed += 1
+                if len(errors) < INGEST_MAX_ERRORS:
+                    (action, info), = item.items()
+                    errors.append({'document': position, 'status': info.get('status'), 'error': info.get('error')})
+        finally:
+            if pause_refresh:
+                get_es().indices.put_settings(index=index, body={'index': {'refresh_interval': old_refresh}})#None restores the default
+                get_es().indices.refresh(index=index)
+            index_registry.invalidate(index)
+            invalidate_documents(index)
 
-        return result
\ No newline at end of file
+        seconds = time.time() - start
+        metrics.HOP_SECONDS.observe(seconds, hop='ingest', index=index)
+        metrics.HOP_HITS.inc(indexed, hop='ingest', index=index)
+        log.info('Ingested %d documents into %s in %.1fs, %d failed', indexed, index, seconds, failed,
+                 extra={'index': index, 'indexed': indexed, 'failed': failed, 'seconds': round(seconds, 3)})
+        return {
+            'index': index,
+            'indexed': indexed,
+            'failed': failed,
+            'errors': errors,
+            'seconds': round(seconds, 3),
+            'docs_per_second': round((indexed + failed) / seconds, 1) if seconds else None,
+        }
\ No newline at end of file
@@ -0,0 +1,195 @@
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import metrics
+from elastic_functions import ESKNN
+from link_index import link_id, link_index
+
+
+JOIN_DOCUMENTS = config.JOIN_DOCUMENTS#entities with their own index -> (index, ID field), eg {'study': ('tblstudy', 'CRGStudyID')}
+JOIN_LINKS = config.JOIN_LINKS#link tables between two entities: (index, entity, its ID field, other entity, its ID field)
+STUDY_FIELD = config.STUDY_FIELD#the study ID field the in-memory link tables are keyed on
+ID_CHUNK_SIZE = config.ID_CHUNK_SIZE#max number of IDs a hop looks up at once
+ID_LOOKUP_THREADS = config.ID_LOOKUP_THREADS#batches looked up at the same time by every hop
+
+Edge = namedtuple('Edge', ['source', 'target', 'index', 'source_field', 'target_field'])#one hop: search source_field in index, read target_field
+
+_esknn = ESKNN()#every hop names its index, so the current index of this instance is never used
+_DONE = object()
+
+
+class JoinGraph():
+    ''' The entities of the register (study, report, condition, ...) and the link tables between them. Every link
+    table can be followed in both directions, and path() finds the shortest chain of link tables between two entities.
+    '''
+
+    def __init__(self, documents=JOIN_DOCUMENTS, links=JOIN_LINKS) -> None:
+        self.documents = dict(documents)
+        self.edges = {}#entity -> [Edge, ...] leaving it
+        for index, source, source_field, target, target_field in links:
+            self.edges.setdefault(source, []).append(Edge(source, target, index, source_field, target_field))
+            self.edges.setdefault(target, []).append(Edge(target, source, index, target_field, source_field))
+
+    def entities(self) -> list:
+        return sorted(set(self.documents) | set(self.edges))
+
+    def id_field(self, entity) -> str:
+        ''' The ID field of an entity: the one of its own index, or else the one its link tables use
+        '''
+        if entity in self.documents:
+            return self.documents[entity][1]
+        return self.edges[entity][0].source_field
+
+    def _shortest(self, start, target) -> list:
+        previous = {start: None}
+        todo = deque([start])
+        while todo:
+            entity = todo.popleft()
+            if entity == target:
+                path = []
+                while previous[entity] is not None:
+                    path.append(previous[entity])
+                    entity = previous[entity].source
+                return path[::-1]
+            for edge in self.edges.get(entity, []):
+                if edge.target not in previous:
+                    previous[edge.target] = edge
+                    todo.append(edge.target)
+        raise ValueError('No join path from {} to {}'.format(start, target))
+
+    def path(self, start, target, via=()) -> list:
+        ''' Shortest list of Edges from start to target, passing through the entities in via in that order.
+        An empty list when start is target. Raises ValueError for unknown entities or when there is no path.
+        '''
+        stops = [start] + list(via) + [target]
+        unknown = [e for e in stops if e not in self.documents and e not in self.edges]
+        if unknown:
+            raise ValueError('Unknown entity {}, use one of {}'.format(', '.join(map(str, unknown)), ', '.join(self.entities())))
+        return [edge for a, b in zip(stops, stops[1:]) for edge in self._shortest(a, b)]
+
+
+def link_batch(edge, ids, deadline=None) -> list:
+    ''' IDs of edge.target linked to a batch of edge.source IDs, with repeats. Answered from the in-memory link
+    tables when the table is loaded, from elastic (within the deadline) otherwise.
+    '''
+    links = link_index.get(edge.index)
+    if links is not None and link_index.link_tables.get(edge.index) in (edge.source_field, edge.target_field):
+        if edge.target_field == STUDY_FIELD:
+            return [p[1] for p in links.to_studies(ids)]
+        if edge.source_field == STUDY_FIELD:
+            return [p[1] for p in links.from_studies(ids)]
+    found = []
+    for doc in _esknn.retrieve_documents(ids, edge.source_field, index=edge.index, include=[edge.source_field, edge.target_field],
+                                         deadline=deadline):
+        value = doc.get(edge.target_field)
+        found.extend(link_id(v) for v in (value if isinstance(value, list) else [value]) if v is not None)
+    return found
+
+
+def _new_batches(results, seen):
+    ''' Batches of at most ID_CHUNK_SIZE IDs from lists of IDs, leaving out IDs already in seen (compared as
+    strings, so 5 and '5' are the same ID). A batch is passed on as soon as its list is read.
+    '''
+    for ids in results:
+        fresh = []
+        for i in ids:
+            key = str(i).strip()
+            if key not in seen:
+                seen.add(key)
+                fresh.append(i)
+        for start in range(0, len(fresh), ID_CHUNK_SIZE):
+            yield fresh[start:start + ID_CHUNK_SIZE]
+
+
+class _Stage():
+    ''' One hop of a pipeline: a thread that takes batches from the previous hop as they arrive and looks each up
+    on a pool of `threads` threads. Iterating over the stage gives the results in the order of the batches; at most
+    `threads` results wait to be picked up, so a slow next hop holds this one back instead of filling memory.
+    '''
+
+    def __init__(self, func, batches, threads, stop) -> None:
+        self.stop = stop
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.results = queue.Queue(maxsize=threads)
+        self.thread = threading.Thread(target=self._submit, args=(func, batches), name='join-hop', daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                self.results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _submit(self, func, batches) -> None:
+        try:
+            for batch in batches:
+                if not self._put(self.pool.submit(func, batch)):
+                    return
+        except Exception as e:#a failed earlier hop, passed on to whoever reads the results
+            self._put(e)
+            return
+        self._put(_DONE)
+
+    def __iter__(self):
+        while not self.stop.is_set():
+            try:
+                item = self.results.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item.result()
+
+    def close(self) -> None:
+        self.thread.join()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def traverse(ids, path, documents=None, include=None, exclude=None, threads=ID_LOOKUP_THREADS, deadline=None, id_field=None):
+    ''' Generator over what is linked to ids through path (a list of Edges from JoinGraph.path).
+    Every hop runs in its own thread: batches of IDs found by one hop are deduplicated and passed to the next hop
+    while the first is still looking up its other batches, so the hops overlap and a traversal takes about as
+    long as its slowest hop rather than the sum of all hops.
+
+    documents: (index, ID field) of the last entity; its documents are yielded, filtered by include/exclude.
+    Without it the IDs of the last entity are yielded as {id_field: id} dicts; id_field defaults to the field the
+    last hop reads, so give it for an empty path (see JoinGraph.id_field).
+    deadline: Deadline of the request, for every hop that goes to elastic; what is found in time is yielded and
+    deadline.partial is set.
+    '''
+    stop = threading.Event()
+    stages = []
+    batches = _new_batches([ids], set())
+    for edge in path:
+        stages.append(_Stage(lambda batch, edge=edge: link_batch(edge, batch, deadline), batches, threads, stop))
+        batches = _new_batches(stages[-1], set())
+    if documents is not None:
+        index, field = documents
+        stages.append(_Stage(lambda batch: _esknn.retrieve_documents(batch, field, index=index, include=include, exclude=exclude,
+                                                                     deadline=deadline),
+                             batches, threads, stop))
+        results = stages[-1]
+    else:
+        field = id_field or (path[-1].target_field if path else STUDY_FIELD)
+        results = ([{field: i} for i in batch] for batch in batches)
+
+    with metrics.hop('traverse', '->'.join([path[0].source] + [e.target for e in path]) if path else '') as h:
+        try:
+            for docs in results:
+                h.hits += len(docs)
+                yield from docs
+        finally:
+            stop.set()#also when the consumer went away early
+            for stage in stages:
+                stage.close()
+
+
+join_graph = JoinGraph()
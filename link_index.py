@@ -0,0 +1,161 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from array import array
+
+from elasticsearch import helpers
+
+import config
+import elastic_functions
+import metrics
+
+
+LINK_TABLES = config.LINK_TABLES#link tables that map other IDs to study IDs, eg {'report': ('tblstudyreport', 'CRGReportID')}
+STUDY_FIELD = config.STUDY_FIELD#the study ID field every link table has, eg 'CRGStudyID'
+LINK_INDEX_ENABLED = config.LINK_INDEX_ENABLED#keep the link tables in memory and answer the first join hop from there
+LINK_INDEX_REFRESH = config.LINK_INDEX_REFRESH#seconds between two reloads of the link tables
+
+log = logging.getLogger(__name__)
+
+
+def link_id(value):
+    ''' A linked ID as the in-memory tables return it: an int when it is one, eg '123' from a CSV ingest,
+    otherwise unchanged. Joins that go to elastic pass their IDs through this too, so both paths give the same type.
+    '''
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            return value
+    return value
+
+
+class LinkTable():
+    ''' Both directions of one link table, as parallel sorted arrays of 64 bit integers:
+    (keys, studies) sorted by key and (studies, keys) sorted by study. A lookup is a binary search per ID.
+    '''
+
+    def __init__(self, pairs, name='') -> None:
+        self.name = name#index the links come from, for metrics
+        pairs = sorted(set(pairs))
+        self.by_key = (array('q', [p[0] for p in pairs]), array('q', [p[1] for p in pairs]))
+        pairs.sort(key=lambda p: (p[1], p[0]))
+        self.by_study = (array('q', [p[1] for p in pairs]), array('q', [p[0] for p in pairs]))
+        self.loaded_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.by_key[0])
+
+    def _find(self, sorted_arrays, ids) -> list:
+        keys, targets = sorted_arrays
+        found = []
+        with metrics.hop('link_index', self.name) as h:
+            for i in dict.fromkeys(ids):
+                try:
+                    i = int(str(i).strip())
+                except ValueError:
+                    continue#not an integer, so it can not be in the table
+                lo = bisect.bisect_left(keys, i)
+                hi = bisect.bisect_right(keys, i, lo)
+                found.extend((i, targets[j]) for j in range(lo, hi))
+            h.hits = len(found)
+        return found
+
+    def to_studies(self, ids) -> list:
+        ''' (id, study id) pairs for the given ids, in the order of ids
+        '''
+        return self._find(self.by_key, ids)
+
+    def from_studies(self, study_ids) -> list:
+        ''' (study id, id) pairs for the given study ids, in the order of study_ids
+        '''
+        return self._find(self.by_study, study_ids)
+
+
+class LinkIndex():
+    ''' In-memory copies of the link tables in LINK_TABLES, reloaded in a background thread every
+    LINK_INDEX_REFRESH seconds. Tables that are not loaded (yet), or can not be held as integers, are not
+    returned by get(), and callers then go to elastic as before.
+    '''
+
+    def __init__(self, tables=LINK_TABLES, refresh=LINK_INDEX_REFRESH) -> None:
+        self.link_tables = dict(tables.values())#index name -> linked ID field
+        self.refresh = refresh
+        self.tables = {}#index name -> LinkTable
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, index_name):
+        return self.tables.get(index_name)
+
+    def load(self, index_name) -> None:
+        ''' Read one link table from elastic and swap it in
+        '''
+        field = self.link_tables[index_name]
+        pairs = []
+        try:
+            for hit in helpers.scan(elastic_functions.get_es(), index=index_name, query={'_source': [field, STUDY_FIELD]}, size=5000):
+                source = hit.get('_source', {})
+                keys, studies = source.get(field), source.get(STUDY_FIELD)
+                if keys is None or studies is None:
+                    continue
+                for key in (keys if isinstance(keys, list) else [keys]):
+                    for study in (studies if isinstance(studies, list) else [studies]):
+                        pairs.append((int(key), int(study)))
+        except Exception as e:
+            log.warning('Could not load %s into memory, joins will query elastic instead (%s)', index_name, e, extra={'index': index_name})
+            self.tables.pop(index_name, None)
+            return
+        self.tables[index_name] = LinkTable(pairs, index_name)
+        log.info('Loaded %d links from %s', len(self.tables[index_name]), index_name, extra={'index': index_name, 'links': len(self.tables[index_name])})
+
+    def written(self, index_name) -> None:
+        ''' Reload a link table right after documents were written to it, instead of at its next refresh.
+        Other worker processes pick the change up at their own next refresh.
+        '''
+        if not LINK_INDEX_ENABLED or index_name not in self.link_tables:
+            return
+        elastic_functions.get_es().indices.refresh(index=index_name)#the new links are only searchable after a refresh
+        self.load(index_name)
+
+    def load_all(self) -> None:
+        for index_name in self.link_tables:
+            self.load(index_name)
+
+    def _refresh_forever(self) -> None:
+        while True:
+            oldest = min((t.loaded_at for t in list(self.tables.values())), default=0)
+            if len(self.tables) < len(self.link_tables) or time.time() - oldest >= self.refresh:
+                self.load_all()#tables inherited from a preloading parent process are only reloaded once they are due
+                oldest = time.time()
+            time.sleep(max(1, self.refresh - (time.time() - oldest)))
+
+    def state(self) -> dict:
+        ''' Number of links and age in seconds of every table in memory, for the health endpoints
+        '''
+        now = time.time()
+        return {
+            'enabled': LINK_INDEX_ENABLED,
+            'running': self._pid == os.getpid(),
+            'tables': {name: {'links': len(t), 'age': round(now - t.loaded_at, 1)} for name, t in list(self.tables.items())},
+            'missing': [name for name in self.link_tables if name not in self.tables],
+        }
+
+    def start(self) -> None:
+        ''' Start the background loader once per process. Cheap to call on every request; after a fork the
+        child process starts its own loader, because threads do not survive a fork.
+        '''
+        if not LINK_INDEX_ENABLED or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._refresh_forever, name='link-index', daemon=True).start()
+
+
+link_index = LinkIndex()
+metrics.registry.add(metrics.Gauge('link_index_links', 'Links held in memory per link table', labels=('index',),
+                                   read=lambda: {(name,): len(t) for name, t in list(link_index.tables.items())}))
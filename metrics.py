@@ -0,0 +1,232 @@
+import asyncio
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from elastic_transport.client_utils import DEFAULT
+
+import config
+
+
+METRICS_ENABLED = config.METRICS_ENABLED#collect request and elastic timings for /metrics
+LATENCY_BUCKETS = config.LATENCY_BUCKETS#upper bounds in seconds of the latency histogram buckets
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    ''' Monotonic counter with labels, eg es_requests_total{endpoint="_search",status="200"}
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}#label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, '') for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return ['{}{} {}'.format(self.name, _labels(self.label_names, key), _number(value))
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram():
+    ''' Histogram with fixed buckets and labels, rendered as cumulative _bucket, _sum and _count lines
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}#label values -> [count per bucket (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, '') for n in self.label_names)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, _labels(self.label_names, key, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.label_names, key), _number(total)))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.label_names, key), cumulative))
+        return lines
+
+
+class Gauge():
+    ''' Value read at scrape time from a function that returns {label values tuple: value}
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), read=None) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.read = read
+
+    def samples(self) -> list:
+        try:
+            values = self.read()
+        except Exception:#a broken gauge must not break the whole scrape
+            return []
+        return ['{}{} {}'.format(self.name, _labels(self.label_names, key), _number(value)) for key, value in sorted(values.items())]
+
+
+class Registry():
+    ''' All metrics of this worker process, rendered in the Prometheus text format.
+    With several worker processes every process has its own registry, so scrape each worker or aggregate them.
+    '''
+
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+####################Flask requests
+REQUEST_SECONDS = registry.add(Histogram('http_request_duration_seconds', 'Time from request to the last byte of the response',
+                                         labels=('endpoint', 'method', 'status')))
+RESPONSE_BYTES = registry.add(Counter('http_response_bytes_total', 'Bytes sent in response bodies', labels=('endpoint',)))
+
+####################Every HTTP request to elastic, timed in the client's node class
+ES_REQUEST_SECONDS = registry.add(Histogram('es_request_duration_seconds', 'Round trip of one HTTP request to elastic',
+                                            labels=('endpoint', 'method')))
+ES_TOOK_SECONDS = registry.add(Histogram('es_took_seconds', "Search time reported by elastic itself ('took')",
+                                         labels=('endpoint',)))
+ES_REQUESTS = registry.add(Counter('es_requests_total', 'HTTP requests to elastic', labels=('endpoint', 'status')))
+ES_BYTES = registry.add(Counter('es_bytes_total', 'Bytes of request and response bodies exchanged with elastic',
+                                labels=('endpoint', 'direction')))
+
+####################Hops: the steps of an endpoint, eg the link table lookup and the study lookup of /api/studyfromanyid
+HOP_SECONDS = registry.add(Histogram('hop_duration_seconds', 'Time spent in one step of a request', labels=('hop', 'index')))
+HOP_HITS = registry.add(Counter('hop_hits_total', 'Documents or values returned by a step', labels=('hop', 'index')))
+LOOKUP_CHUNKS = registry.add(Counter('lookup_chunks_total', 'ID chunks looked up by retrieve_documents, answered from elastic or cache',
+                                     labels=('index', 'source')))
+
+####################Query strings: rewritten, rejected or throttled by query_analyzer before they reach elastic
+QUERY_ANALYSIS = registry.add(Counter('query_analysis_total', 'Query strings analysed before searching, by what happened to them',
+                                      labels=('outcome',)))
+
+
+class Hop():
+    ''' Counts of one running hop, filled in by the code inside metrics.hop()
+    '''
+
+    def __init__(self) -> None:
+        self.hits = 0
+
+
+@contextmanager
+def hop(name, index=''):
+    ''' Time one step of a request and count its hits:
+        with metrics.hop('lookup', 'tblstudy') as h:
+            ...
+            h.hits += len(docs)
+    For a generator the hop lasts until the generator is exhausted or closed.
+    '''
+    h = Hop()
+    start = time.perf_counter()
+    try:
+        yield h
+    finally:
+        HOP_SECONDS.observe(time.perf_counter() - start, hop=name, index=index)
+        HOP_HITS.inc(h.hits, hop=name, index=index)
+
+
+_TOOK = re.compile(rb'"took": ?(\d+)')
+
+
+def _endpoint(target) -> str:
+    ''' Low-cardinality name of an elastic API from a request path, eg /tblreport/_search?scroll=5m -> _search
+    '''
+    parts = [p for p in target.split('?', 1)[0].split('/') if p.startswith('_') or p == 'scroll']
+    return '/'.join(parts) if parts else ('info' if target in ('', '/') else 'index')
+
+
+def _record(method, target, body, status, data, seconds) -> None:
+    endpoint = _endpoint(target)
+    ES_REQUEST_SECONDS.observe(seconds, endpoint=endpoint, method=method)
+    ES_REQUESTS.inc(endpoint=endpoint, status=status)
+    if body:
+        ES_BYTES.inc(len(body), endpoint=endpoint, direction='sent')
+    if data:
+        ES_BYTES.inc(len(data), endpoint=endpoint, direction='received')
+        if endpoint in ('_search', '_msearch', '_search/scroll'):
+            took = _TOOK.search(data, 0, 4096)#'took' comes first, after a scroll or point in time id at most
+            if took:
+                ES_TOOK_SECONDS.observe(int(took.group(1)) / 1000, endpoint=endpoint)
+
+
+def instrumented(node_class):
+    ''' Subclass of an elastic_transport node class that times every request to elastic and counts its bytes.
+    Works for sync (eg Urllib3HttpNode) and async (eg AiohttpHttpNode) node classes.
+    '''
+    if asyncio.iscoroutinefunction(node_class.perform_request):
+        async def perform_request(self, method, target, body=None, headers=None, request_timeout=DEFAULT):
+            start = time.perf_counter()
+            status, data = 'error', None
+            try:
+                response = await node_class.perform_request(self, method, target, body=body, headers=headers, request_timeout=request_timeout)
+                status, data = response.meta.status, response.body
+                return response
+            finally:
+                _record(method, target, body, status, data, time.perf_counter() - start)
+    else:
+        def perform_request(self, method, target, body=None, headers=None, request_timeout=DEFAULT):
+            start = time.perf_counter()
+            status, data = 'error', None
+            try:
+                response = node_class.perform_request(self, method, target, body=body, headers=headers, request_timeout=request_timeout)
+                status, data = response.meta.status, response.body
+                return response
+            finally:
+                _record(method, target, body, status, data, time.perf_counter() - start)
+    return type('Instrumented' + node_class.__name__, (node_class,), {'perform_request': perform_request})
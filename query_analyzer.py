@@ -0,0 +1,231 @@
+'''
+Analysis of the Lucene query strings sent to elastic's query_string query, before they are searched.
+
+Every query is split into its clauses and each clause gets a rough cost, in units of one exact term lookup.
+Wildcards are what make query strings expensive: 'schizo*' walks the terms starting with 'schizo', but a leading
+wildcard like 'Authors:*dams' has to walk the whole term dictionary of the field. Where the index maps the
+subfields for it, such clauses are rewritten into cheap ones:
+
+    Authors:*dams  ->  Authors.reverse:smad*     (the field indexed with a reverse token filter)
+    Authors:*dam*  ->  Authors.ngram:"dam"       (the field indexed with an n-gram tokenizer)
+
+for a mapping like
+    "Authors": {"type": "text", "fields": {"reverse": {"type": "text", "analyzer": "reverse"},
+                                           "ngram": {"type": "text", "analyzer": "trigram"}}}
+with a 'reverse' analyzer (standard tokenizer, lowercase and reverse filters) and a 'trigram' analyzer
+(ngram tokenizer with min_gram = max_gram = QUERY_NGRAM_MIN and token_chars letter and digit, lowercase filter).
+
+Queries that still cost more than QUERY_MAX_COST are rejected; those above QUERY_THROTTLE_COST are let through
+QUERY_THROTTLE_SLOTS at a time per worker process.
+'''
+import logging
+import re
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import config
+import metrics
+from caching import LRUCache
+
+
+QUERY_MAX_COST = config.QUERY_MAX_COST#queries with a higher estimated cost are rejected, 0 turns the check off
+QUERY_THROTTLE_COST = config.QUERY_THROTTLE_COST#queries costing more than this wait for one of QUERY_THROTTLE_SLOTS, 0 turns throttling off
+QUERY_THROTTLE_SLOTS = config.QUERY_THROTTLE_SLOTS#expensive queries running at the same time per worker process
+QUERY_THROTTLE_WAIT = config.QUERY_THROTTLE_WAIT#seconds an expensive query waits for a slot before it is turned away
+QUERY_REWRITE = config.QUERY_REWRITE#rewrite leading and infix wildcards to the reverse and n-gram subfields
+REVERSE_SUBFIELD = config.QUERY_REVERSE_SUBFIELD#eg 'reverse' for Authors.reverse
+NGRAM_SUBFIELD = config.QUERY_NGRAM_SUBFIELD#eg 'ngram' for Authors.ngram
+NGRAM_MIN = config.QUERY_NGRAM_MIN#shortest string the n-gram subfields can find
+QUERY_ANALYSIS_CACHE_SIZE = config.QUERY_ANALYSIS_CACHE_SIZE#parsed query strings kept, by query text
+
+log = logging.getLogger(__name__)
+
+#cost of one clause, in units of one exact term lookup
+_TERM_COST = 1
+_RANGE_COST = 10
+_FUZZY_COST = 20
+_PREFIX_COST = 60#divided by the length of the literal prefix: 'a*' walks far more terms than 'schizo*'
+_SCAN_COST = 500#leading wildcards and regexps without a literal prefix walk the whole term dictionary
+_ALL_FIELDS_FACTOR = 5#clauses without a field (or with a wildcard field) are searched in every field
+
+Clause = namedtuple('Clause', ['field', 'kind', 'text', 'start', 'end'])#one term, phrase, range or regexp; start/end include its 'field:'
+Analysis = namedtuple('Analysis', ['query', 'cost', 'rewrites'])#query to send, its estimated cost, [(clause, rewritten clause), ...]
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<operator>&&|\|\||(?:AND|OR|NOT)(?![^\s()])|[+\-!](?=\S))
+  | (?P<field>(?:[^\s\\:()"\[\]{}^~/]|\\.)+:(?=\S))
+  | (?P<phrase>"(?:[^"\\]|\\.)*"?)
+  | (?P<regexp>/(?:[^/\\]|\\.)*/)
+  | (?P<range>[\[{][^\]}]*[\]}]?)
+  | (?P<modifier>[~^][\d.]*)
+  | (?P<term>(?:[^\s\\:()"\[\]{}^~/]|\\.)+)
+  | (?P<other>.)
+''', re.X | re.S)
+
+_parsed = LRUCache(QUERY_ANALYSIS_CACHE_SIZE, float('inf'))#query text -> clauses; parsing only depends on the text, so entries never expire
+_slots = threading.BoundedSemaphore(max(1, QUERY_THROTTLE_SLOTS))
+
+
+class QueryTooExpensive(ValueError):
+    ''' A query string whose estimated cost is over QUERY_MAX_COST, or an expensive one that found no free slot in time
+    '''
+
+
+def _wildcards(text) -> list:
+    ''' Positions of the unescaped * and ? in a term
+    '''
+    found, escaped = [], False
+    for i, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '*?':
+            found.append(i)
+    return found
+
+
+def _classify(text) -> str:
+    wildcards = _wildcards(text)
+    if not wildcards:
+        return 'term'
+    if text == '*':
+        return 'exists'#field:* is answered from the field's existence, *:* matches everything
+    if wildcards[0] > 0:
+        return 'prefix'#walks the terms that start with the literal prefix
+    if wildcards == [0, len(text) - 1] and text[0] == text[-1] == '*' and len(text) > 2:
+        return 'infix'
+    return 'leading'
+
+
+def _parse(query) -> tuple:
+    clauses = []
+    groups = [None]#field of every open bracket, eg Authors:(adams OR smith)
+    field = None#(name, start) of a 'field:' that waits for its term
+    for match in _TOKEN.finditer(query):
+        kind, text = match.lastgroup, match.group()
+        if kind == 'space':
+            continue
+        if kind == 'field':
+            field = (text[:-1], match.start())
+            continue
+        if kind == 'open':
+            groups.append(field[0] if field else groups[-1])
+        elif kind == 'close':
+            if len(groups) > 1:
+                groups.pop()
+        elif kind == 'modifier':
+            if text.startswith('~') and clauses and clauses[-1].end == match.start() and clauses[-1].kind == 'term':
+                clauses[-1] = clauses[-1]._replace(kind='fuzzy')
+        elif kind in ('term', 'phrase', 'regexp', 'range'):
+            name, start = field if field else (groups[-1], match.start())
+            clauses.append(Clause(name, _classify(text) if kind == 'term' else kind, text, start, match.end()))
+        field = None
+    return tuple(clauses)
+
+
+def parse(query) -> tuple:
+    ''' The clauses of a query string, in the order they appear. Cached by query text.
+    '''
+    clauses = _parsed.get(query)
+    if clauses is None:
+        clauses = _parse(query)
+        _parsed.set(query, clauses)
+    return clauses
+
+
+def cost(clause) -> int:
+    ''' Rough cost of searching one clause, in units of one exact term lookup
+    '''
+    kind, text = clause.kind, clause.text
+    if kind in ('term', 'exists'):
+        estimate = _TERM_COST
+    elif kind == 'phrase':
+        estimate = max(1, len(text.strip('"').split()))
+    elif kind == 'range':
+        estimate = _RANGE_COST
+    elif kind == 'fuzzy':
+        estimate = _FUZZY_COST
+    elif kind == 'prefix':
+        estimate = max(2, _PREFIX_COST // _wildcards(text)[0])
+    elif kind == 'regexp':
+        literal = len(re.match(r'\w*', text[1:]).group())
+        estimate = max(2, _PREFIX_COST // literal) if literal else _SCAN_COST
+    else:
+        estimate = _SCAN_COST
+    if clause.field is None or '*' in clause.field or '?' in clause.field:
+        estimate *= _ALL_FIELDS_FACTOR
+    return estimate
+
+
+def _rewrite(clause, has_field):
+    ''' The clause on a reverse or n-gram subfield, or None if it can not be rewritten
+    '''
+    if clause.field is None or '*' in clause.field or '?' in clause.field or '\\' in clause.text:
+        return None
+    if clause.kind == 'leading' and clause.text[-1] not in '*?':
+        subfield = '{}.{}'.format(clause.field, REVERSE_SUBFIELD)
+        if has_field(subfield):
+            return clause._replace(field=subfield, kind='prefix', text=clause.text[::-1])
+    elif clause.kind == 'infix' and len(clause.text) - 2 >= NGRAM_MIN and not _wildcards(clause.text[1:-1]):
+        subfield = '{}.{}'.format(clause.field, NGRAM_SUBFIELD)
+        if has_field(subfield):
+            return clause._replace(field=subfield, kind='phrase', text='"{}"'.format(clause.text[1:-1]))
+    return None
+
+
+def analyze(query, has_field=lambda field: False) -> Analysis:
+    ''' Estimate the cost of a query string and rewrite its leading and infix wildcards where possible.
+
+    has_field: function telling whether the searched index maps a field, eg Authors.reverse
+    :return: Analysis with the query to send, its cost and the rewritten clauses
+    '''
+    rewrites, total = [], 0
+    for clause in parse(query):
+        rewritten = _rewrite(clause, has_field) if QUERY_REWRITE and clause.kind in ('leading', 'infix') else None
+        if rewritten is not None:
+            rewrites.append((clause, rewritten))
+            clause = rewritten
+        total += cost(clause)
+
+    if rewrites:
+        parts, last = [], 0
+        for clause, rewritten in rewrites:
+            parts.extend([query[last:clause.start], '{}:{}'.format(rewritten.field, rewritten.text)])
+            last = clause.end
+        query = ''.join(parts) + query[last:]
+    metrics.QUERY_ANALYSIS.inc(outcome='rewritten' if rewrites else 'unchanged')
+    return Analysis(query, total, rewrites)
+
+
+def check(analysis) -> None:
+    ''' Raise QueryTooExpensive if the query costs more than QUERY_MAX_COST
+    '''
+    if QUERY_MAX_COST and analysis.cost > QUERY_MAX_COST:
+        metrics.QUERY_ANALYSIS.inc(outcome='rejected')
+        log.info('Rejected query of cost %d', analysis.cost, extra={'query': analysis.query, 'cost': analysis.cost})
+        raise QueryTooExpensive('Your query is too expensive to run (estimated cost {}, at most {} is allowed). '
+                                'Leading wildcards like *dams and searches without a field cost the most'.format(analysis.cost, QUERY_MAX_COST))
+
+
+@contextmanager
+def throttle(query_cost):
+    ''' Hold one of QUERY_THROTTLE_SLOTS slots while a query costing more than QUERY_THROTTLE_COST runs, so a burst
+    of expensive queries queues up instead of taking every worker thread and the cluster with it.
+    Raises QueryTooExpensive if no slot frees up within QUERY_THROTTLE_WAIT seconds.
+    '''
+    if not QUERY_THROTTLE_COST or query_cost <= QUERY_THROTTLE_COST:
+        yield
+        return
+    metrics.QUERY_ANALYSIS.inc(outcome='throttled')
+    if not _slots.acquire(timeout=QUERY_THROTTLE_WAIT):
+        metrics.QUERY_ANALYSIS.inc(outcome='busy')
+        raise QueryTooExpensive('Too many expensive queries are running, try again later or avoid leading wildcards like *dams')
+    try:
+        yield
+    finally:
+        _slots.release()
@@ -1,9 +1,99 @@
+import argparse
+import logging
+import multiprocessing
+
+import config
 from app import app
+import async_elastic_functions
+import elastic_functions
+from link_index import link_index
+
+log = logging.getLogger('run')
+
+
+####################gunicorn server hooks, see https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+def on_starting(server):
+    ''' Runs once in the master before any worker is forked: the link tables loaded here are shared with all
+    workers (copy on write), so they start warm instead of each scanning the link tables themselves
+    '''
+    if elastic_functions.get_es().options(request_timeout=2, max_retries=0).ping():#do not hold up the start when elastic is down
+        link_index.load_all()
+
+
+def post_fork(server, worker):
+    ''' Runs in every new worker: build its own elastic clients (the master's are dropped at fork) and start its
+    link table refresher, before the first request comes in
+    '''
+    elastic_functions.get_es()
+    async_elastic_functions.get_loop()
+    link_index.start()
+    log.info('Worker %d ready', worker.pid)
+
+
+def worker_exit(server, worker):
+    ''' Close the connection pool of a stopping worker, after its last request has finished
+    '''
+    if elastic_functions._es is not None:
+        elastic_functions._es.close()
+
+
+def production_options(workers=None, threads=None, bind=None) -> dict:
+    ''' gunicorn settings from config.py, with command line overrides
+    '''
+    return {
+        'bind': bind or config.SERVER_BIND,
+        'workers': workers or config.SERVER_WORKERS or multiprocessing.cpu_count(),
+        'worker_class': 'gthread',
+        'threads': threads or config.SERVER_THREADS,
+        'worker_connections': config.SERVER_WORKER_CONNECTIONS,
+        'backlog': config.SERVER_BACKLOG,
+        'timeout': config.SERVER_TIMEOUT,
+        'graceful_timeout': config.SERVER_GRACEFUL_TIMEOUT,
+        'max_requests': config.SERVER_MAX_REQUESTS,
+        'max_requests_jitter': config.SERVER_MAX_REQUESTS // 10,
+        'preload_app': True,#import the app once in the master, workers share its memory
+        'on_starting': on_starting,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+
+
+def serve(options) -> None:
+    ''' Serve app with gunicorn: a pool of worker processes, each with a pool of threads. Connections beyond
+    workers * worker_connections wait in a listen backlog of SERVER_BACKLOG and are refused once that is full.
+    SIGTERM stops accepting connections and gives running requests SERVER_GRACEFUL_TIMEOUT seconds to finish.
+    '''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit('run.py: --production needs gunicorn (pip install gunicorn), which only runs on unix')
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
 
 if __name__ == "__main__":
 
-    app.run(
-        host='0.0.0.0',
-        port=9090,
-        debug=True
-    )
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run the meerkat elastic API')
+    parser.add_argument('--production', action='store_true', help='serve with gunicorn workers instead of the flask development server')
+    parser.add_argument('--workers', type=int, help='worker processes, default SERVER_WORKERS or one per CPU core')
+    parser.add_argument('--threads', type=int, help='threads per worker, default SERVER_THREADS')
+    parser.add_argument('--bind', help='address to listen on, default SERVER_BIND')
+    args = parser.parse_args()
+
+    if args.production:
+        serve(production_options(args.workers, args.threads, args.bind))
+    else:
+        app.run(
+            host='0.0.0.0',
+            port=9090,
+            debug=True
+        )
@@ -0,0 +1,179 @@
+import csv
+import fnmatch
+import io
+import json
+import logging
+import re
+
+from flask.json.provider import DefaultJSONProvider
+
+import config
+
+try:
+    import orjson
+except ImportError:#optional, the standard library json is used without it
+    orjson = None
+
+
+RIS_FIELDS = config.RIS_FIELDS#RIS tag -> document field, in the order the tags are written
+PUBMED_FIELDS = config.PUBMED_FIELDS#MEDLINE/PubMed tag -> document field, in the order the tags are written
+AUTHOR_SEPARATOR = config.AUTHOR_SEPARATOR#authors are stored as one string, separated by this character
+FAST_JSON = config.FAST_JSON and orjson is not None#encode JSON with orjson instead of the standard library
+
+FORMATS = {#return_as -> (mimetype, file extension) of the formats format_output can stream
+    'ris': ('application/x-research-info-systems', 'ris'),
+    'pubmed': ('text/plain', 'txt'),
+    'csv': ('text/csv', 'csv'),
+}
+
+
+def _values(doc, field, tag=None) -> list:
+    ''' Values of a document field as a list of strings, with author strings split into single authors
+    '''
+    value = doc.get(field)
+    if value is None or value == '':
+        return []
+    values = value if isinstance(value, list) else [value]
+    if tag in ('AU', 'A1'):
+        values = [a for v in values for a in str(v).split(AUTHOR_SEPARATOR)]
+    return [' '.join(str(v).split()) for v in values if str(v).strip()]#no line breaks inside a tag
+
+
+def to_ris(doc) -> str:
+    ''' One document as a RIS record
+    '''
+    lines = ['TY  - JOUR']
+    for tag, field in RIS_FIELDS.items():
+        lines.extend('{}  - {}'.format(tag, v) for v in _values(doc, field, tag))
+    lines.append('ER  - ')
+    return '\n'.join(lines) + '\n\n'
+
+
+def to_pubmed(doc) -> str:
+    ''' One document as a MEDLINE/PubMed-style text record, as in PubMed's "PubMed format" downloads
+    '''
+    lines = []
+    for tag, field in PUBMED_FIELDS.items():
+        lines.extend('{:<4}- {}'.format(tag, v) for v in _values(doc, field, tag))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _columns(patterns, doc) -> list:
+    ''' CSV columns for a list of field names that may contain wildcards, eg the 'include' fields of a request:
+    every pattern becomes the fields of doc it matches, in the order of doc
+    '''
+    columns = []
+    for pattern in patterns:
+        if any(char in pattern for char in '*?['):
+            columns.extend(field for field in doc if fnmatch.fnmatchcase(field, pattern) and field not in columns)
+        elif pattern not in columns:
+            columns.append(pattern)
+    return columns
+
+
+def to_csv(records, columns=None):
+    ''' Generator over CSV lines (header first). Columns are taken from the first record unless given, and
+    columns with wildcards (eg 'Tit*') are matched against the fields of the first record;
+    fields that only appear in later records are left out, lists are joined with '; '.
+    '''
+    buffer = io.StringIO()
+    writer = None
+    for doc in records:
+        if writer is None:
+            columns = _columns(columns, doc) if columns else list(doc)
+            writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({k: '; '.join(map(str, v)) if isinstance(v, list) else v for k, v in doc.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def format_output(records, return_as=config.RETURN_AS, columns=None):
+    ''' Convert documents one at a time into the requested download format.
+
+    records: iterable of documents, usually a generator over elastic hits
+    return_as: 'ris', 'pubmed' or 'csv' (see FORMATS)
+    columns: optional list of CSV columns, wildcards allowed
+    :return: generator over text chunks, one per document (plus the CSV header)
+    '''
+    if return_as == 'csv':
+        return to_csv(records, columns)
+    if return_as == 'ris':
+        return (to_ris(doc) for doc in records)
+    if return_as == 'pubmed':
+        return (to_pubmed(doc) for doc in records)
+    raise ValueError('Unknown return_as {}, use dict, {}'.format(return_as, ', '.join(FORMATS)))
+
+
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+_COMPACT = (',', ':')
+
+
+def _escape(match) -> str:
+    ''' \\uXXXX escape of one character, as a surrogate pair outside the basic plane, the same as json.dumps
+    '''
+    n = ord(match.group())
+    if n < 0x10000:
+        return '\\u{:04x}'.format(n)
+    n -= 0x10000
+    return '\\u{:04x}\\u{:04x}'.format(0xd800 | (n >> 10), 0xdc00 | (n & 0x3ff))
+
+
+class JSONProvider(DefaultJSONProvider):
+    ''' Flask JSON provider that encodes compact output (what responses use) with orjson, and everything else (indented output, odd
+    keyword arguments, or values orjson refuses such as non-string keys or integers over 64 bits) with the
+    standard library json, like the default provider. Keys are sorted and non-ASCII characters escaped in both
+    cases, so the response bytes are mostly the same whichever encoder wrote them. They differ for floats written
+    with an exponent (orjson writes 1e16 and 1e-7 where json writes 1e+16 and 1e-07, the same numbers) and for
+    NaN and Infinity, which orjson writes as null and json as NaN and Infinity (not valid JSON).
+    benchmark/run.py --compare-json checks every benchmark response against flask's own provider.
+    '''
+
+    def dumps(self, obj, **kwargs) -> str:
+        if FAST_JSON and kwargs == {'separators': _COMPACT}:
+            try:
+                text = orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                                    | orjson.OPT_PASSTHROUGH_DATACLASS).decode()
+            except TypeError:#orjson.JSONEncodeError
+                pass
+            else:
+                return text if not self.ensure_ascii or text.isascii() else _NON_ASCII.sub(_escape, text)
+        return super().dumps(obj, **kwargs)
+
+
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class StructuredFormatter(logging.Formatter):
+    ''' Log lines with the fields passed as extra={...}: either one JSON object per line, or plain text
+    followed by key=value pairs
+    '''
+
+    def __init__(self, as_json=False) -> None:
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.as_json = as_json
+
+    def format(self, record) -> str:
+        fields = {k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS}
+        if not self.as_json:
+            text = super().format(record)
+            return ' '.join([text] + ['{}={}'.format(k, v) for k, v in fields.items()])
+        line = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        line.update(fields)
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def setup_logging(level=config.LOG_LEVEL, as_json=config.LOG_JSON) -> None:
+    ''' Send the logs of all modules to stderr with StructuredFormatter, once per process
+    '''
+    root = logging.getLogger()
+    if any(isinstance(h.formatter, StructuredFormatter) for h in root.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(as_json))
+    root.addHandler(handler)
+    root.setLevel(level)
+    logging.getLogger('elastic_transport').setLevel(logging.WARNING)#one line per request to elastic otherwise